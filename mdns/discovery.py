@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from zeroconf import (
+    DNSPointer,
+    DNSService,
+    ServiceStateChange,
+    Zeroconf,
+    current_time_millis,
+)
+from zeroconf.asyncio import (
+    AsyncServiceBrowser,
+    AsyncServiceInfo,
+    AsyncZeroconf,
+    AsyncZeroconfServiceTypes,
+)
+
+# Discover services with asyncio rather than blocking threads
+# The service types are enumerated once, then one AsyncServiceBrowser watches
+# all of them. Browser callbacks run in the event loop and only schedule work,
+# the services they announce are resolved concurrently, at most concurrency at
+# a time so hundreds of services do not flood the network, and each resolved
+# ServiceInfo is cached until the service is updated or removed. Removing or
+# updating a service cancels a resolution of it still in flight, so a stale
+# result never brings it back.
+
+log = logging.getLogger(__name__)
+
+# Called with the state change and the service's type, name and info
+# (None when removed)
+Listener = Callable[[ServiceStateChange, str, str, Optional[AsyncServiceInfo]], None]
+
+
+def valid_type(service_type: str) -> bool:
+    """Service names are at most 15 characters, zeroconf rejects longer ones"""
+    return len(service_type.split(".")[0]) <= 15
+
+
+class AsyncDiscovery:
+    def __init__(
+        self,
+        aiozc: AsyncZeroconf,
+        concurrency: int = 32,
+        resolve_timeout_ms: int = 3000,
+        types_timeout: float = 5,
+    ):
+        self.aiozc = aiozc
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.resolve_timeout_ms = resolve_timeout_ms
+        self.types_timeout = types_timeout
+        self.types: Tuple[str, ...] = ()
+        # (type, name) to its resolved info
+        self.cache: Dict[Tuple[str, str], AsyncServiceInfo] = {}
+        self.listeners: List[Listener] = []
+        self.browser: Optional[AsyncServiceBrowser] = None
+        # Keep references so pending resolutions are not garbage collected
+        self.tasks: Set[asyncio.Task] = set()
+        # (type, name) to its resolution in flight
+        self.resolving: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def on_change(self, listener: Listener):
+        self.listeners.append(listener)
+
+    async def find_types(self) -> Tuple[str, ...]:
+        types = await AsyncZeroconfServiceTypes.async_find(
+            aiozc=self.aiozc, timeout=self.types_timeout
+        )
+        self.types = tuple(t for t in types if valid_type(t))
+        return self.types
+
+    async def start(self, types: Optional[List[str]] = None):
+        """Browse the given types, or every type found on the network"""
+        if types is None:
+            types = list(await self.find_types())
+        else:
+            self.types = tuple(types)
+        if types:
+            self.browser = AsyncServiceBrowser(
+                self.aiozc.zeroconf, types, handlers=[self._state_changed]
+            )
+
+    def _state_changed(
+        self,
+        zeroconf: Zeroconf,
+        service_type: str,
+        name: str,
+        state_change: ServiceStateChange,
+    ):
+        key = (service_type, name)
+        pending = self.resolving.get(key)
+        if state_change is ServiceStateChange.Removed:
+            if pending:
+                pending.cancel()
+            self.cache.pop(key, None)
+            self._notify(state_change, service_type, name, None)
+            return
+        if state_change is ServiceStateChange.Added and (key in self.cache or pending):
+            return
+        if pending:
+            # Superseded by the update, which still adds it if it was never added
+            pending.cancel()
+            if key not in self.cache:
+                state_change = ServiceStateChange.Added
+        task = asyncio.ensure_future(self._resolve(state_change, service_type, name))
+        self.tasks.add(task)
+        self.resolving[key] = task
+        task.add_done_callback(lambda task: self._resolved(key, task))
+
+    def _resolved(self, key: Tuple[str, str], task: asyncio.Task):
+        self.tasks.discard(task)
+        if self.resolving.get(key) is task:
+            del self.resolving[key]
+
+    async def _resolve(
+        self, state_change: ServiceStateChange, service_type: str, name: str
+    ):
+        info = AsyncServiceInfo(service_type, name)
+        async with self.semaphore:
+            found = await info.async_request(
+                self.aiozc.zeroconf, self.resolve_timeout_ms
+            )
+        if not found:
+            log.info(f"Service {name} did not resolve")
+            return
+        self.cache[(service_type, name)] = info
+        self._notify(state_change, service_type, name, info)
+
+    def _notify(
+        self,
+        state_change: ServiceStateChange,
+        service_type: str,
+        name: str,
+        info: Optional[AsyncServiceInfo],
+    ):
+        for listener in self.listeners:
+            try:
+                listener(state_change, service_type, name, info)
+            except Exception:
+                log.exception(f"Listener failed for {name}")
+
+    def ttl(self, service_type: str, name: str) -> Optional[float]:
+        """Seconds left on the service's SRV record, or the PTR record announcing
+        it which the browser keeps refreshed, in zeroconf's cache. None once both
+        have gone."""
+        now = current_time_millis()
+        cache = self.aiozc.zeroconf.cache
+        remaining = [
+            record.get_remaining_ttl(now)
+            for record in cache.entries_with_name(name.lower())
+            if isinstance(record, DNSService) and not record.is_expired(now)
+        ]
+        remaining += [
+            record.get_remaining_ttl(now)
+            for record in cache.entries_with_name(service_type.lower())
+            if isinstance(record, DNSPointer)
+            and record.alias.lower() == name.lower()
+            and not record.is_expired(now)
+        ]
+        return max(remaining, default=None)
+
+    async def resolved(self):
+        """Wait for the resolutions already started"""
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def close(self):
+        if self.browser:
+            await self.browser.async_cancel()
+        for task in self.tasks:
+            task.cancel()
@@ -1,7 +1,22 @@
+import argparse
+import asyncio
+import json
 import logging
 import sys
+from typing import Dict, List, Optional
 
-from zeroconf import ServiceBrowser, Zeroconf, ZeroconfServiceTypes
+from zeroconf import (
+    InterfaceChoice,
+    IPVersion,
+    ServiceBrowser,
+    ServiceStateChange,
+    Zeroconf,
+    ZeroconfServiceTypes,
+)
+from zeroconf.asyncio import AsyncServiceInfo, AsyncZeroconf
+
+from discovery import AsyncDiscovery, valid_type
+from registry import Registry
 
 # A quick study to learn a bit about the mDNS/Bonjour systems on my home network
 # Much of this code was copied from https://github.com/jstasiak/python-zeroconf
@@ -18,18 +33,132 @@ class MyListener:
         info = zeroconf.get_service_info(type, name)
         print("Service %s added, service info: %s" % (name, info))
 
+    def update_service(self, zeroconf, type, name):
+        pass
+
+
+def list_sync(interfaces):
+    """The original, blocking discovery, resolving one service at a time"""
+    types = ZeroconfServiceTypes.find(interfaces=interfaces)
+    print("\n".join(types))
+
+    zeroconf = Zeroconf(interfaces=interfaces)
+    listener = MyListener()
+    browsers = []
+    for s in types:
+        if valid_type(s):
+            print(f"browsing {s}")
+            browsers.append(ServiceBrowser(zeroconf, s, listener))
+
+    try:
+        input("Press enter to exit...\n\n")  # nosec
+    finally:
+        zeroconf.close()
+
+
+def print_change(
+    state_change: ServiceStateChange,
+    service_type: str,
+    name: str,
+    info: Optional[AsyncServiceInfo],
+):
+    if info is None:
+        print(f"Service {name} {state_change.name.lower()}")
+    else:
+        print(f"Service {name} {state_change.name.lower()}, service info: {info}")
+
+
+def print_json(change: Dict):
+    print(json.dumps(change), flush=True)
+
+
+async def list_async(
+    interfaces,
+    concurrency: int,
+    seconds: Optional[float],
+    types: List[str],
+    feed: bool,
+    snapshot_path: Optional[str],
+    snapshot_seconds: float,
+):
+    aiozc = AsyncZeroconf(
+        interfaces=interfaces,
+        ip_version=None if interfaces is InterfaceChoice.All else IPVersion.V4Only,
+    )
+    discovery = AsyncDiscovery(aiozc, concurrency=concurrency)
+    registry = Registry(ttl=discovery.ttl)
+    registry.track(discovery)
+    if feed:
+        registry.on_change(print_json)
+    else:
+        discovery.on_change(print_change)
+    maintain = asyncio.ensure_future(registry.maintain(snapshot_seconds, snapshot_path))
+    try:
+        await discovery.start(types or None)
+        if not feed:
+            print("\n".join(discovery.types))
+        if seconds is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(seconds)
+    finally:
+        maintain.cancel()
+        await discovery.close()
+        await aiozc.async_close()
+        if snapshot_path:
+            registry.write_snapshot(snapshot_path)
 
-print("\n".join(ZeroconfServiceTypes.find()))
 
-zeroconf = Zeroconf()
-listener = MyListener()
-browsers = []
-for s in ZeroconfServiceTypes.find():
-    if len(s.split(".")[0]) <= 15:
-        print(f"browsing {s}")
-        browsers.append(ServiceBrowser(zeroconf, s, listener))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the mDNS services nearby")
+    parser.add_argument(
+        "--sync", action="store_true", help="the original, blocking discovery"
+    )
+    parser.add_argument(
+        "--interface",
+        action="append",
+        help="an address to browse from e.g. 127.0.0.1, all of them by default",
+    )
+    parser.add_argument(
+        "--type",
+        action="append",
+        default=[],
+        help="a service type to browse rather than every type found",
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--seconds", type=float, help="how long to browse, until Ctrl-C by default"
+    )
+    parser.add_argument(
+        "--feed",
+        action="store_true",
+        help="print every change to the registry as a line of JSON",
+    )
+    parser.add_argument(
+        "--snapshot", help="a file to keep a JSON snapshot of the registry in"
+    )
+    parser.add_argument(
+        "--snapshot-seconds",
+        type=float,
+        default=5,
+        help="how often to write the snapshot if anything changed",
+    )
+    args = parser.parse_args()
+    interfaces = args.interface or InterfaceChoice.All
 
-try:
-    input("Press enter to exit...\n\n")  # nosec
-finally:
-    zeroconf.close()
+    if args.sync:
+        list_sync(interfaces)
+    else:
+        try:
+            asyncio.run(
+                list_async(
+                    interfaces,
+                    args.concurrency,
+                    args.seconds,
+                    args.type,
+                    args.feed,
+                    args.snapshot,
+                    args.snapshot_seconds,
+                )
+            )
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,300 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import socket
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from zeroconf import ServiceInfo, ServiceStateChange
+
+# An in-memory registry of the services discovered so far
+# Services are indexed by name, by type and by address so a lookup is a
+# dictionary access rather than another browse of the network. Each service
+# expires when its records' TTL runs out. Expiry times are kept in a heap and
+# checked lazily, before every query and from maintain(), and a service which
+# is due is only expired if the ttl callback, which reads zeroconf's record
+# cache, does not report its records were refreshed since.
+# Every added, updated, removed or expired service is numbered and passed to
+# the change listeners, e.g. to stream them as JSON lines, and snapshot()
+# returns the whole registry with the sequence number it is up to date with.
+
+log = logging.getLogger(__name__)
+
+ADDED = "added"
+UPDATED = "updated"
+REMOVED = "removed"
+EXPIRED = "expired"
+
+# Called with a change like {"sequence": 1, "change": "added", "service": {...}}
+ChangeListener = Callable[[Dict], None]
+
+
+def write_json(path: str, data: Dict):
+    """Replace the JSON file at path atomically"""
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+class Service:
+    __slots__ = ("type", "name", "server", "port", "addresses", "properties", "expires")
+
+    def __init__(
+        self,
+        type: str,
+        name: str,
+        server: Optional[str],
+        port: Optional[int],
+        addresses: Tuple[str, ...],
+        properties: Dict[str, Optional[str]],
+        expires: float,
+    ):
+        self.type = type
+        self.name = name
+        self.server = server
+        self.port = port
+        self.addresses = addresses
+        self.properties = properties
+        # On the registry's clock
+        self.expires = expires
+
+    @classmethod
+    def from_info(cls, info: ServiceInfo, expires: float) -> "Service":
+        return cls(
+            info.type,
+            info.name,
+            info.server,
+            info.port,
+            tuple(info.parsed_addresses()),
+            {
+                k.decode(errors="replace"): (
+                    v.decode(errors="replace") if v is not None else None
+                )
+                for (k, v) in info.properties.items()
+            },
+            expires,
+        )
+
+    def same_as(self, other: "Service") -> bool:
+        """Whether the records match, regardless of when they expire"""
+        return all(
+            getattr(self, attr) == getattr(other, attr)
+            for attr in self.__slots__
+            if attr != "expires"
+        )
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "type": self.type,
+            "name": self.name,
+            "server": self.server,
+            "port": self.port,
+            "addresses": list(self.addresses),
+            "properties": self.properties,
+            "ttl": max(0, round(self.expires - now)),
+        }
+
+
+class Registry:
+    def __init__(
+        self,
+        ttl: Optional[Callable[[str, str], Optional[float]]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        # Given a service's type and name, the seconds left on its records or
+        # None once they are gone
+        self.ttl = ttl
+        self.clock = clock
+        self.services: Dict[str, Service] = {}
+        self.by_type: Dict[str, Set[str]] = {}
+        self.by_address: Dict[str, Set[str]] = {}
+        # (expires, name), entries for services since refreshed are skipped
+        self.expiries: List[Tuple[float, str]] = []
+        self.sequence = 0
+        self.listeners: List[ChangeListener] = []
+
+    def on_change(self, listener: ChangeListener):
+        self.listeners.append(listener)
+
+    def track(self, discovery):
+        """Keep up to date with an AsyncDiscovery"""
+
+        def changed(state_change, service_type, name, info):
+            if state_change is ServiceStateChange.Removed or info is None:
+                self.remove(name)
+            else:
+                self.put(info, self.ttl(service_type, name) if self.ttl else None)
+
+        discovery.on_change(changed)
+
+    def put(self, info: ServiceInfo, ttl: Optional[float] = None) -> Optional[str]:
+        """Add or update a resolved service, which expires after ttl seconds (by
+        default its host records' TTL). Returns the change, if any."""
+        expires = self.clock() + (ttl if ttl is not None else info.host_ttl)
+        service = Service.from_info(info, expires)
+        current = self.services.get(service.name)
+        heapq.heappush(self.expiries, (expires, service.name))
+        if current is not None and current.same_as(service):
+            current.expires = expires
+            return None
+        if current is not None:
+            self._unindex(current)
+        self.services[service.name] = service
+        self.by_type.setdefault(service.type, set()).add(service.name)
+        for address in service.addresses:
+            self.by_address.setdefault(address, set()).add(service.name)
+        change = UPDATED if current is not None else ADDED
+        self._notify(change, service)
+        return change
+
+    def remove(self, name: str, change: str = REMOVED) -> bool:
+        service = self.services.pop(name, None)
+        if service is None:
+            return False
+        self._unindex(service)
+        self._notify(change, service)
+        return True
+
+    def _unindex(self, service: Service):
+        names = self.by_type.get(service.type)
+        if names is not None:
+            names.discard(service.name)
+            if not names:
+                del self.by_type[service.type]
+        for address in service.addresses:
+            names = self.by_address.get(address)
+            if names is not None:
+                names.discard(service.name)
+                if not names:
+                    del self.by_address[address]
+
+    def _notify(self, change: str, service: Service):
+        self.sequence += 1
+        if not self.listeners:
+            return
+        event = {
+            "sequence": self.sequence,
+            "change": change,
+            "service": service.to_dict(self.clock()),
+        }
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception:
+                log.exception(f"Change listener failed for {service.name}")
+
+    def expire(self) -> List[str]:
+        """Expire the services whose records have run out, returns their names"""
+        now = self.clock()
+        expired = []
+        while self.expiries and self.expiries[0][0] <= now:
+            (expires, name) = heapq.heappop(self.expiries)
+            service = self.services.get(name)
+            if service is None or service.expires != expires:
+                continue
+            remaining = self.ttl(service.type, name) if self.ttl else None
+            if remaining:
+                # Refreshed without changing, so discovery did not hear of it
+                service.expires = now + remaining
+                heapq.heappush(self.expiries, (service.expires, name))
+                continue
+            self.remove(name, EXPIRED)
+            expired.append(name)
+        return expired
+
+    # Queries
+
+    def get(self, name: str) -> Optional[Service]:
+        self.expire()
+        return self.services.get(name)
+
+    def of_type(self, service_type: str) -> List[Service]:
+        self.expire()
+        return [self.services[n] for n in self.by_type.get(service_type, ())]
+
+    def at_address(self, address: str) -> List[Service]:
+        self.expire()
+        return [self.services[n] for n in self.by_address.get(address, ())]
+
+    def types(self) -> List[str]:
+        self.expire()
+        return sorted(self.by_type)
+
+    def __iter__(self) -> Iterator[Service]:
+        self.expire()
+        return iter(list(self.services.values()))
+
+    def __len__(self) -> int:
+        self.expire()
+        return len(self.services)
+
+    # Export
+
+    def snapshot(self) -> Dict:
+        self.expire()
+        now = self.clock()
+        return {
+            "sequence": self.sequence,
+            "taken": time.time(),
+            "services": [
+                s.to_dict(now)
+                for s in sorted(self.services.values(), key=lambda s: s.name)
+            ],
+        }
+
+    def write_snapshot(self, path: str):
+        write_json(path, self.snapshot())
+
+    async def maintain(self, interval: float = 1, snapshot_path: Optional[str] = None):
+        """Expire services on time, and write a snapshot when anything changed"""
+        written = -1
+        while True:
+            self.expire()
+            if snapshot_path and written != self.sequence:
+                written = self.sequence
+                await asyncio.get_running_loop().run_in_executor(
+                    None, write_json, snapshot_path, self.snapshot()
+                )
+            await asyncio.sleep(interval)
+
+
+if __name__ == "__main__":
+    # Manual tests, on a fake clock with a fake record cache for the ttl
+    now = [0.0]
+    records: Dict[str, float] = {}
+    registry = Registry(lambda _, name: records.get(name), lambda: now[0])
+    changes: List[Dict] = []
+    registry.on_change(changes.append)
+
+    def info(name: str, address: str, port: int = 80) -> ServiceInfo:
+        return ServiceInfo(
+            "_toy._tcp.local.",
+            f"{name}._toy._tcp.local.",
+            addresses=[socket.inet_aton(address)],
+            port=port,
+            properties={"path": "/"},
+            server=f"{name}.local.",
+        )
+
+    print("\nregistry tests")
+    print(1, registry.put(info("a", "10.0.0.1"), ttl=10))
+    print(2, registry.put(info("b", "10.0.0.2"), ttl=20))
+    # The same records again only move the expiry
+    print(3, registry.put(info("a", "10.0.0.1"), ttl=10))
+    print(4, registry.put(info("a", "10.0.0.3", port=81), ttl=10))
+    print(5, sorted(s.name for s in registry.of_type("_toy._tcp.local.")))
+    print(6, [s.name for s in registry.at_address("10.0.0.1")])
+    print(7, [s.name for s in registry.at_address("10.0.0.3")])
+
+    # a is due but its records were refreshed in the cache, b is gone
+    now[0] = 15
+    records["a._toy._tcp.local."] = 30
+    print(8, registry.expire(), registry.get("a._toy._tcp.local.").expires)
+    now[0] = 25
+    print(9, registry.expire(), len(registry), registry.at_address("10.0.0.2"))
+    print(10, registry.remove("a._toy._tcp.local."), registry.remove("missing"))
+    print(11, registry.types(), registry.by_type, registry.by_address)
+    print(12, [(c["sequence"], c["change"], c["service"]["name"]) for c in changes])
+    print(13, registry.snapshot()["sequence"])
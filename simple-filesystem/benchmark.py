@@ -0,0 +1,181 @@
+import argparse
+import itertools
+import json
+import math
+import random
+import resource
+import subprocess  # nosec
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from filesystem import FileSystem
+
+# Compare the FileSystem trie against the original dictionary of dictionaries
+# Each implementation runs in its own process so peak RSS measures its tree.
+# e.g. python benchmark.py --nodes 10000000
+
+
+# The original implementation, kept here as the baseline
+def dict_mkdir(filestore: Dict[str, Any], path: str):
+    leaf_dir = filestore
+    directories = [d for d in path.split("/") if d != ""]
+    for d in directories:
+        if type(leaf_dir.get(d)) == dict:  # noqa: E721
+            leaf_dir = leaf_dir[d]
+        else:
+            leaf_dir[d] = dict()
+            leaf_dir = leaf_dir[d]
+    return filestore
+
+
+def dict_list_files(filestore: Dict[str, Any], path: str) -> Optional[List[str]]:
+    leaf_dir = filestore
+    directories = [d for d in path.split("/") if d != ""]
+    for d in directories:
+        if type(leaf_dir.get(d)) == dict:  # noqa: E721
+            leaf_dir = leaf_dir[d]
+
+    if leaf_dir:
+        list_of_files: List[str] = []
+        for k in leaf_dir:
+            if type(leaf_dir[k]) == dict:  # noqa: E721
+                list_of_files.append(f"dir {k}")
+            else:
+                list_of_files.append(f"fil {k}")
+        return list_of_files
+    return None
+
+
+def dict_get_file(filestore: Dict[str, Any], path: str) -> Optional[str]:
+    leaf_dir = filestore
+    directories = [d for d in path.split("/") if d != ""]
+    for d in directories:
+        if type(leaf_dir.get(d)) == dict:  # noqa: E721
+            leaf_dir = leaf_dir[d]
+        else:
+            return leaf_dir.get(d)
+    return None
+
+
+def dict_write_file(filestore: Dict[str, Any], path: str, data: str) -> Optional[str]:
+    leaf_dir = filestore
+    directories = [d for d in path.split("/") if d != ""]
+    for d in directories:
+        if type(leaf_dir.get(d)) == dict:  # noqa: E721
+            leaf_dir = leaf_dir[d]
+        else:
+            leaf_dir[d] = data
+            return data
+    return None
+
+
+def operations(impl: str) -> Tuple[Callable, Callable, Callable, Callable]:
+    """mkdir, list_files, get_file and write_file of an implementation"""
+    if impl == "dict":
+        filestore: Dict[str, Any] = dict()
+        return (
+            lambda path: dict_mkdir(filestore, path),
+            lambda path: dict_list_files(filestore, path),
+            lambda path: dict_get_file(filestore, path),
+            lambda path, data: dict_write_file(filestore, path, data),
+        )
+    fs = FileSystem(path_cache_size=1024 if impl == "trie-cache" else 0)
+    return (fs.mkdir, fs.list_files, fs.get_file, fs.write_file)
+
+
+def leaf_dirs(nodes: int, depth: int, files_per_dir: int) -> Iterator[str]:
+    """Directory paths depth deep with enough of them to hold about nodes files"""
+    count = max(1, nodes // (files_per_dir + 1))
+    fanout = max(1, math.ceil(count ** (1 / depth)))
+    for parts in itertools.islice(
+        itertools.product(range(fanout), repeat=depth), count
+    ):
+        yield "/" + "/".join(f"dir{p}" for p in parts)
+
+
+def max_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def rate(count: int, start: float) -> float:
+    return round(count / (time.perf_counter() - start))
+
+
+def run(impl: str, nodes: int, depth: int, files_per_dir: int, samples: int) -> Dict:
+    (mkdir, list_files, get_file, write_file) = operations(impl)
+    rss_before = max_rss_bytes()
+
+    start = time.perf_counter()
+    ops = 0
+    for path in leaf_dirs(nodes, depth, files_per_dir):
+        mkdir(path)
+        for f in range(files_per_dir):
+            write_file(f"{path}/file{f}", b"data")
+        ops += files_per_dir + 1
+    build_rate = rate(ops, start)
+    rss_after = max_rss_bytes()
+
+    # Revisit a sample of directories in random order
+    dirs = list(itertools.islice(leaf_dirs(nodes, depth, files_per_dir), samples))
+    rand = random.Random(0)  # nosec
+    lookups = [
+        f"{rand.choice(dirs)}/file{rand.randrange(files_per_dir)}"
+        for _ in range(samples)
+    ]
+    start = time.perf_counter()
+    for path in lookups:
+        get_file(path)
+    get_rate = rate(len(lookups), start)
+
+    start = time.perf_counter()
+    for path in lookups:
+        write_file(path, b"more data")
+    write_rate = rate(len(lookups), start)
+
+    start = time.perf_counter()
+    for path in dirs:
+        list_files(path)
+    list_rate = rate(len(dirs), start)
+
+    return {
+        "impl": impl,
+        "nodes": ops,
+        "tree_mb": round((rss_after - rss_before) / 2**20),
+        "build_ops_per_sec": build_rate,
+        "get_file_per_sec": get_rate,
+        "write_file_per_sec": write_rate,
+        "list_files_per_sec": list_rate,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simple filesystem")
+    parser.add_argument("--nodes", type=int, default=10_000_000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--samples", type=int, default=100_000)
+    parser.add_argument("--impl", choices=["dict", "trie", "trie-cache"])
+    args = parser.parse_args()
+
+    if args.impl:
+        result = run(
+            args.impl, args.nodes, args.depth, args.files_per_dir, args.samples
+        )
+        print(json.dumps(result))
+    else:
+        for impl in ["dict", "trie", "trie-cache"]:
+            output = subprocess.run(  # nosec
+                [sys.executable, __file__, "--impl", impl]
+                + [f"--nodes={args.nodes}", f"--depth={args.depth}"]
+                + [
+                    f"--files-per-dir={args.files_per_dir}",
+                    f"--samples={args.samples}",
+                ],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            print(output.strip())
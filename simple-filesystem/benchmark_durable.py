@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict
+
+from durable import DurableFileSystem
+
+# Compare cold starts of a DurableFileSystem from its whole log against from a
+# snapshot and a short log tail. The history rewrites the same files over and
+# over, as a long lived filesystem does, so the log grows with every operation
+# while the snapshot only grows with the tree.
+# e.g. python benchmark_durable.py --files 10000 --rewrites 50
+
+
+def build(directory: str, files: int, rewrites: int, snapshot: bool) -> Dict:
+    fs = DurableFileSystem(directory, snapshot_every=2**62)
+    start = time.perf_counter()
+    for d in range(100):
+        fs.mkdir(f"/dir{d}")
+    for r in range(rewrites):
+        for f in range(files):
+            fs.write_file(f"/dir{f % 100}/file{f}", f"data {r}".encode())
+    ops_per_sec = round(fs.logged / (time.perf_counter() - start))
+    if snapshot:
+        fs.snapshot()
+        # A tail of operations since the snapshot
+        for f in range(min(files, 1000)):
+            fs.write_file(f"/dir{f % 100}/file{f}", b"tail")
+    fs.close()
+    return {"logged_ops_per_sec": ops_per_sec, "disk_kb": disk_kb(directory)}
+
+
+def disk_kb(directory: str) -> int:
+    return round(
+        sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        / 1024
+    )
+
+
+def cold_start(directory: str) -> float:
+    start = time.perf_counter()
+    fs = DurableFileSystem(directory)
+    elapsed = time.perf_counter() - start
+    fs.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark durable cold starts")
+    parser.add_argument("--files", type=int, default=10_000)
+    parser.add_argument("--rewrites", type=int, default=50)
+    args = parser.parse_args()
+
+    for (name, snapshot) in [("log", False), ("snapshot", True)]:
+        with tempfile.TemporaryDirectory() as directory:
+            result = build(directory, args.files, args.rewrites, snapshot)
+            result["start"] = name
+            result["cold_start_ms"] = round(cold_start(directory) * 1000, 1)
+            print(json.dumps(result))
@@ -0,0 +1,103 @@
+import argparse
+import json
+import random
+import threading
+import time
+from typing import Callable, Dict, List
+
+from concurrentfs import ConcurrentFileSystem
+from filesystem import FileSystem
+
+# Read throughput of a ConcurrentFileSystem while writer threads keep changing
+# it, against a FileSystem shared behind a single lock. Each writer rewrites
+# files in its own directory and each reader reads random files and lists
+# random directories for a fixed time.
+# Reads of the concurrent filesystem take no lock so they only scale with
+# readers where threads run in parallel, i.e. a free-threaded build with
+# spare cores.
+# e.g. python benchmark_threads.py --readers 1 2 4 8 --writers 2
+
+
+class LockedFileSystem:
+    """The baseline, every operation holds one lock"""
+
+    def __init__(self):
+        self.fs = FileSystem()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self.fs, name)
+
+        def locked(*args):
+            with self.lock:
+                return method(*args)
+
+        return locked
+
+
+def build(fs, dirs: int, files: int):
+    for d in range(dirs):
+        fs.mkdir(f"/dir{d}")
+        for f in range(files):
+            fs.write_file(f"/dir{d}/file{f}", b"data")
+
+
+def run(
+    impl: str, readers: int, writers: int, dirs: int, files: int, seconds: float
+) -> Dict:
+    fs = ConcurrentFileSystem() if impl == "cow" else LockedFileSystem()
+    build(fs, dirs, files)
+    stop = threading.Event()
+    reads: List[int] = [0] * readers
+    writes: List[int] = [0] * writers
+
+    def reader(r: int):
+        rand = random.Random(r)  # nosec
+        while not stop.is_set():
+            d = rand.randrange(dirs)
+            fs.get_file(f"/dir{d}/file{rand.randrange(files)}")
+            fs.list_files(f"/dir{d}")
+            reads[r] += 2
+
+    def writer(w: int):
+        rand = random.Random(-w - 1)  # nosec
+        while not stop.is_set():
+            # Writer w owns every directory d where d % writers == w
+            d = w + writers * rand.randrange(max(1, dirs // writers))
+            fs.write_file(f"/dir{d}/file{rand.randrange(files)}", b"more data")
+            writes[w] += 1
+
+    threads = [threading.Thread(target=reader, args=(r,)) for r in range(readers)]
+    threads += [threading.Thread(target=writer, args=(w,)) for w in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "impl": impl,
+        "readers": readers,
+        "writers": writers,
+        "reads_per_sec": round(sum(reads) / elapsed),
+        "writes_per_sec": round(sum(writes) / elapsed),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent readers")
+    parser.add_argument("--readers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--dirs", type=int, default=100)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    for impl in ["cow", "locked"]:
+        for readers in args.readers:
+            result = run(
+                impl, readers, args.writers, args.dirs, args.files, args.seconds
+            )
+            print(json.dumps(result))
@@ -0,0 +1,81 @@
+import argparse
+import json
+import time
+import tracemalloc
+from typing import Dict
+
+from filesystem import FileSystem
+
+# Benchmark walk, glob and du on deep and wide synthetic trees
+# A deep tree is a single chain of directories with a file in each and a wide
+# tree is one directory holding every file. Memory is the peak allocated
+# while iterating, which stays flat however many entries are walked.
+# e.g. python benchmark_walk.py --deep 10000 --wide 1000000
+
+
+def deep_tree(depth: int) -> FileSystem:
+    fs = FileSystem()
+    path = ""
+    for d in range(depth):
+        path = f"{path}/d{d}"
+        fs.mkdir(path)
+        fs.write_file(f"{path}/file.txt", b"data")
+    return fs
+
+
+def wide_tree(width: int) -> FileSystem:
+    fs = FileSystem()
+    fs.mkdir("/wide")
+    for f in range(width):
+        fs.write_file(f"/wide/file{f}.txt", b"data")
+    return fs
+
+
+def count_traversal(fs: FileSystem, path: str) -> int:
+    """What du costs without the aggregates, reading every file beneath path"""
+    total = 0
+    for entry in fs.walk(path):
+        if entry.startswith("fil "):
+            total += len(fs.get_file(entry[4:]) or b"")
+    return total
+
+
+def timed_iteration(iterable) -> Dict:
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = sum(1 for _ in iterable)
+    elapsed = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "entries": count,
+        "entries_per_sec": round(count / elapsed) if elapsed else count,
+        "peak_kb": round(peak / 1024),
+    }
+
+
+def run(name: str, fs: FileSystem) -> Dict:
+    start = time.perf_counter()
+    du = fs.du("/")
+    du_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    traversal = count_traversal(fs, "/")
+    traversal_seconds = time.perf_counter() - start
+    assert du and du[0] == traversal  # nosec
+    return {
+        "tree": name,
+        "walk": timed_iteration(fs.walk("/")),
+        "glob": timed_iteration(fs.glob("/**/*.txt")),
+        "du_usec": round(du_seconds * 1e6, 1),
+        "traversal_du_usec": round(traversal_seconds * 1e6, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark walk, glob and du")
+    parser.add_argument("--deep", type=int, default=10_000)
+    parser.add_argument("--wide", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(json.dumps(run("deep", deep_tree(args.deep))))
+    print(json.dumps(run("wide", wide_tree(args.wide))))
@@ -0,0 +1,293 @@
+import sys
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from filesystem import (
+    Blob,
+    ContentStore,
+    Data,
+    Dir,
+    File,
+    FileSystem,
+    Node,
+    p,
+    split_path,
+)
+
+# A FileSystem which many threads can use at once
+# Published directories are never changed. A write copies the directories on
+# the path from the root down to the one it changes, sharing every other node
+# with the previous tree, then publishes the new root with a single attribute
+# assignment. A reader takes the current root as a Snapshot, without a lock,
+# and sees that point in time however many writes follow.
+# Writers take the lock of the directory they change, from a fixed set of
+# striped locks, for the whole write, so appends to a file never lose each
+# other's data and writers in unrelated directories never wait for each other.
+# A commit copies the path from the root it read without any lock, then
+# publishes its new root with a compare and swap, under commit_lock which
+# only covers comparing and assigning the root. If another write published
+# first the commit is redone against that root, so no write is lost.
+# Contents are always immutable Blobs, so append and pwrite copy the file, and
+# a copied directory costs O(entries), which makes writes to very wide
+# directories expensive.
+
+
+class Snapshot(FileSystem):
+    """A read only, point in time view of a ConcurrentFileSystem"""
+
+    def __init__(self, root: Dir):
+        super().__init__(path_cache_size=0)
+        self.root = root
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("a Snapshot is read only")
+
+    mkdir = write_file = append = pwrite = delete = dedupe = _read_only
+
+
+def copied(leaf_dir: Dir) -> Dir:
+    copy = Dir()
+    copy.children = dict(leaf_dir.children)
+    copy.size = leaf_dir.size
+    copy.files = leaf_dir.files
+    return copy
+
+
+def totals(node: Node) -> Tuple[int, int]:
+    """The size and number of files of a node"""
+    if node.__class__ is Dir:
+        return (node.size, node.files)  # type: ignore
+    return (len(node.data), 1)  # type: ignore
+
+
+def blobs_beneath(node: Node) -> Iterator[Blob]:
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node.__class__ is Dir:
+            stack.extend(node.children.values())  # type: ignore
+        else:
+            yield node.content  # type: ignore
+
+
+class ConcurrentFileSystem:
+    def __init__(self, lock_stripes: int = 64):
+        self.root = Dir()
+        self.commit_lock = threading.Lock()
+        self.locks = [threading.Lock() for _ in range(lock_stripes)]
+        # Reference counts only cover the current tree, older snapshots keep
+        # the Blobs they hold alive themselves
+        self.contents = ContentStore()
+        self.contents_lock = threading.Lock()
+
+    def snapshot(self) -> Snapshot:
+        return Snapshot(self.root)
+
+    def _lock(self, dir_parts: List[str]) -> threading.Lock:
+        return self.locks[hash("/".join(dir_parts)) % len(self.locks)]
+
+    def _lookup(self, parts: List[str]) -> Optional[Node]:
+        node: Node = self.root
+        for d in parts:
+            if node.__class__ is not Dir:
+                return None
+            child = node.children.get(d)  # type: ignore
+            if child is None:
+                return None
+            node = child
+        return node
+
+    def _commit(
+        self,
+        dir_parts: List[str],
+        change: Callable[[Dir], Optional[Dir]],
+        create: bool = False,
+    ) -> Optional[Dir]:
+        """Publish a new root in which the directory at dir_parts is replaced by
+        change(directory). Returns the directory replaced, None if it is missing
+        (and not created) or change returned None. change may be called more
+        than once, when another write publishes first."""
+        while True:
+            root = self.root
+            path = [root]
+            created = False
+            for d in dir_parts:
+                child = path[-1].children.get(d)
+                if child is None:
+                    if not create:
+                        return None
+                    child = Dir()
+                    created = True
+                elif child.__class__ is not Dir:
+                    return None
+                path.append(child)  # type: ignore
+
+            node = change(path[-1])
+            if node is None:
+                return None
+            if node is path[-1] and not created:
+                return node
+            for i in range(len(dir_parts) - 1, -1, -1):
+                parent = copied(path[i])
+                parent.children[sys.intern(dir_parts[i])] = node
+                parent.size += node.size - path[i + 1].size
+                parent.files += node.files - path[i + 1].files
+                node = parent
+            with self.commit_lock:
+                if self.root is root:
+                    self.root = node
+                    return path[-1]
+
+    def _release(self, blobs: Iterator[Blob]):
+        with self.contents_lock:
+            for blob in blobs:
+                self.contents.release(blob)
+
+    def _put(
+        self, path: str, contents: Callable[[Optional[bytes]], Data]
+    ) -> Optional[Blob]:
+        """Replace the file at path, in an existing directory, with the data
+        contents returns given its current data. None if path is a directory."""
+        parts = split_path(path)
+        if not parts:
+            return None
+        (dir_parts, name) = (parts[:-1], parts[-1])
+        with self._lock(dir_parts):
+            current = self._lookup(parts)
+            if current.__class__ is Dir:
+                return None
+            data = contents(current.data if current is not None else None)  # type: ignore
+            with self.contents_lock:
+                blob = self.contents.add(data)
+
+            def change(leaf_dir: Dir) -> Optional[Dir]:
+                node = leaf_dir.children.get(name)
+                if node.__class__ is Dir:
+                    return None
+                new_dir = copied(leaf_dir)
+                new_dir.children[sys.intern(name)] = File(blob)
+                new_dir.size += len(blob.data)
+                if node is None:
+                    new_dir.files += 1
+                else:
+                    new_dir.size -= len(node.data)  # type: ignore
+                return new_dir
+
+            old_dir = self._commit(dir_parts, change)
+            if old_dir is None:
+                self._release(iter([blob]))
+                return None
+            replaced = old_dir.children.get(name)
+            if replaced is not None:
+                self._release(blobs_beneath(replaced))
+            return blob
+
+    def mkdir(self, path: str) -> bool:
+        """Create a directory and any missing parents, False if a file is in the way"""
+        return self._commit(split_path(path), lambda d: d, create=True) is not None
+
+    def write_file(self, path: str, data: Data) -> Optional[Data]:
+        if self._put(path, lambda _: data) is None:
+            return None
+        return data
+
+    def append(self, path: str, data: Data) -> Optional[int]:
+        blob = self._put(path, lambda current: (current or b"") + data)
+        return len(blob.data) if blob is not None else None
+
+    def pwrite(self, path: str, data: Data, offset: int) -> Optional[int]:
+        if offset < 0:
+            raise ValueError(f"invalid offset {offset}")
+
+        def written(current: Optional[bytes]) -> Data:
+            content = bytearray(current or b"")
+            end = offset + len(data)
+            if end > len(content):
+                content.extend(bytes(end - len(content)))
+            content[offset:end] = data
+            return content
+
+        return len(data) if self._put(path, written) is not None else None
+
+    def delete(self, path: str) -> bool:
+        """Delete a file or a directory and everything beneath it"""
+        parts = split_path(path)
+        if not parts:
+            return False
+        (dir_parts, name) = (parts[:-1], parts[-1])
+
+        def change(leaf_dir: Dir) -> Optional[Dir]:
+            if name not in leaf_dir.children:
+                return None
+            new_dir = copied(leaf_dir)
+            (size, files) = totals(new_dir.children.pop(name))
+            new_dir.size -= size
+            new_dir.files -= files
+            return new_dir
+
+        with self._lock(dir_parts):
+            old_dir = self._commit(dir_parts, change)
+        if old_dir is None:
+            return False
+        self._release(blobs_beneath(old_dir.children[name]))
+        return True
+
+    # Reads, each from a snapshot of the moment it is called
+
+    def list_files(self, path: str) -> Optional[List[str]]:
+        return self.snapshot().list_files(path)
+
+    def get_file(self, path: str) -> Optional[bytes]:
+        return self.snapshot().get_file(path)
+
+    def read(
+        self, path: str, offset: int = 0, length: int = -1
+    ) -> Optional[memoryview]:
+        return self.snapshot().read(path, offset, length)
+
+    def du(self, path: str) -> Optional[Tuple[int, int]]:
+        return self.snapshot().du(path)
+
+    def walk(self, path: str = "/") -> Iterator[str]:
+        return self.snapshot().walk(path)
+
+    def glob(self, pattern: str) -> Iterator[str]:
+        return self.snapshot().glob(pattern)
+
+    def to_dict(self) -> Dict:
+        return self.snapshot().to_dict()
+
+
+if __name__ == "__main__":
+    fs = ConcurrentFileSystem()
+
+    # Manual tests
+    print("\nconcurrent filesystem tests")
+    p(1, fs.mkdir("/a/b"))
+    p(2, fs.write_file("/a/b/notes", b"some notes"))
+    before = fs.snapshot()
+    p(3, fs.append("/a/b/notes", b", and more"))
+    p(4, fs.pwrite("/a/b/notes", b"SOME", 0))
+    p(5, fs.write_file("/a", b"a directory"))
+    p(6, (before.get_file("/a/b/notes"), fs.get_file("/a/b/notes")))
+    p(7, fs.du("/"))
+    p(8, fs.delete("/a/b"))
+    p(9, (before.to_dict(), fs.to_dict(), fs.du("/")))
+    p(10, (len(fs.contents.blobs), fs.contents.size))
+
+    print("\nthreaded tests")
+    threads = [
+        threading.Thread(
+            target=lambda t: [fs.append(f"/t{t % 2}/log", b"x") for _ in range(1000)],
+            args=(t,),
+        )
+        for t in range(4)
+    ]
+    fs.mkdir("/t0")
+    fs.mkdir("/t1")
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    p(1, fs.du("/t0"))
+    p(2, fs.du("/"))
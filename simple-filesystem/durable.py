@@ -0,0 +1,334 @@
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from typing import BinaryIO, List, Optional, Tuple
+
+from filesystem import Data, Dir, File, FileSystem, p
+
+# A FileSystem which survives restarts
+# Every mkdir, write_file, append, pwrite and delete is appended to an
+# operation log. Each record is written straight through to the OS, so it
+# survives the process crashing, and records are fsync'd in groups (group
+# commit), every group_commit_ops records and from a flusher thread every
+# group_commit_seconds, so durability against power loss costs one fsync per
+# group rather than per operation. Call sync() to make everything so far
+# durable.
+# Every snapshot_every operations the whole tree is written to a compact binary
+# snapshot and a new log is started. At startup the snapshot is mmap'd and
+# parsed in place, then only the log written since it is replayed, so a cold
+# start costs the size of the tree, not the length of its history.
+#
+# Files in the directory
+#   snapshot     SNAPSHOT_HEADER then the tree in pre-order, see _write_tree
+#   log.<gen>    records appended since the snapshot of generation gen
+# A log record is LOG_HEADER (crc32, op, path length, data length, offset),
+# the utf-8 path and the data. The crc covers everything after itself so a torn
+# write at the end of the log is detected and cut off during recovery.
+
+SNAPSHOT_MAGIC = b"SFS1"
+SNAPSHOT_HEADER = struct.Struct("<4sQ")  # magic, generation
+# crc32, op, path length, data length, offset (of a pwrite)
+LOG_HEADER = struct.Struct("<IBIIQ")
+CRC = struct.Struct("<I")
+LOG_BODY = struct.Struct("<BIIQ")  # LOG_HEADER after the crc
+NAME = struct.Struct("<BI")  # kind, name length
+LENGTH = struct.Struct("<I")  # data length of a file, entries of a directory
+
+MKDIR = 1
+WRITE_FILE = 2
+DELETE = 3
+APPEND = 4
+PWRITE = 5
+
+DIR_KIND = 1
+FILE_KIND = 2
+
+
+class DurableFileSystem(FileSystem):
+    def __init__(
+        self,
+        directory: str,
+        group_commit_ops: int = 256,
+        group_commit_seconds: float = 0.05,
+        snapshot_every: int = 1_000_000,
+        path_cache_size: int = 0,
+    ):
+        super().__init__(path_cache_size)
+        self.directory = directory
+        self.group_commit_ops = group_commit_ops
+        self.group_commit_seconds = group_commit_seconds
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+
+        self.generation = self._load_snapshot()
+        self.logged = self._replay_logs()
+        self._remove_old_logs()
+        # Unbuffered so every record reaches the OS as it is written
+        self.log: BinaryIO = open(self._log_path(self.generation), "ab", buffering=0)
+        self._sync_directory()
+        self.pending = 0
+        # Held to write, fsync or replace the log
+        self.lock = threading.RLock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush, daemon=True)
+        self.flusher.start()
+
+    def _log_path(self, generation: int) -> str:
+        return os.path.join(self.directory, f"log.{generation}")
+
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, "snapshot")
+
+    # Recovery
+
+    def _load_snapshot(self) -> int:
+        """Build the tree from the snapshot, returns its generation (0 if none)"""
+        path = self._snapshot_path()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return 0
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                (magic, generation) = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+                if magic != SNAPSHOT_MAGIC:
+                    raise ValueError(f"{path} is not a filesystem snapshot")
+                self._read_tree(snapshot, SNAPSHOT_HEADER.size)
+        return generation
+
+    def _read_tree(self, snapshot: mmap.mmap, offset: int):
+        """Parse the pre-order tree in place, totalling each directory's size
+        and files as its last entry is read"""
+        (entries,) = LENGTH.unpack_from(snapshot, offset)
+        offset += LENGTH.size
+        # Directories still being read and how many of their entries remain
+        stack: List[Tuple[Dir, int]] = [(self.root, entries)]
+        while stack:
+            (leaf_dir, remaining) = stack[-1]
+            if remaining == 0:
+                stack.pop()
+                if leaf_dir.parent is not None:
+                    leaf_dir.parent.size += leaf_dir.size
+                    leaf_dir.parent.files += leaf_dir.files
+                continue
+            stack[-1] = (leaf_dir, remaining - 1)
+
+            (kind, name_length) = NAME.unpack_from(snapshot, offset)
+            offset += NAME.size
+            name = sys.intern(str(snapshot[offset : offset + name_length], "utf-8"))
+            offset += name_length
+            (length,) = LENGTH.unpack_from(snapshot, offset)
+            offset += LENGTH.size
+            if kind == DIR_KIND:
+                child = Dir(leaf_dir)
+                leaf_dir.children[name] = child
+                stack.append((child, length))
+            else:
+                # Hashed straight from the mapping, only new contents are copied
+                data = memoryview(snapshot)[offset : offset + length]
+                offset += length
+                leaf_dir.children[name] = File(self.contents.add(data))
+                leaf_dir.size += len(data)
+                leaf_dir.files += 1
+
+    def _replay_logs(self) -> int:
+        """Apply the logs written since the snapshot, returns the records applied"""
+        applied = 0
+        generation = self.generation
+        while os.path.exists(self._log_path(generation)):
+            applied += self._replay_log(self._log_path(generation))
+            generation += 1
+        return applied
+
+    def _replay_log(self, path: str) -> int:
+        applied = 0
+        with open(path, "r+b") as log:
+            contents = log.read()
+            offset = 0
+            while offset + LOG_HEADER.size <= len(contents):
+                (crc, op, path_length, data_length, data_offset) = (
+                    LOG_HEADER.unpack_from(contents, offset)
+                )
+                end = offset + LOG_HEADER.size + path_length + data_length
+                body = contents[offset + CRC.size : end]
+                if end > len(contents) or zlib.crc32(body) != crc:
+                    break
+                start = offset + LOG_HEADER.size
+                op_path = contents[start : start + path_length].decode()
+                data = memoryview(contents)[start + path_length : end]
+                self._apply(op, op_path, data, data_offset)
+                applied += 1
+                offset = end
+            if offset < len(contents):
+                # A torn record from a crash, everything before it is intact
+                log.truncate(offset)
+        return applied
+
+    def _remove_old_logs(self):
+        """Logs a snapshot was written over but not yet removed before a crash"""
+        for name in os.listdir(self.directory):
+            (prefix, _, generation) = name.partition(".")
+            if prefix == "log" and generation.isdigit():
+                if int(generation) < self.generation:
+                    os.remove(os.path.join(self.directory, name))
+
+    def _apply(self, op: int, path: str, data: Data, offset: int):
+        if op == MKDIR:
+            super().mkdir(path)
+        elif op == WRITE_FILE:
+            super().write_file(path, data)
+        elif op == DELETE:
+            super().delete(path)
+        elif op == APPEND:
+            super().append(path, data)
+        elif op == PWRITE:
+            super().pwrite(path, data, offset)
+
+    # Logging
+
+    def _log(self, op: int, path: str, data: Data = b"", offset: int = 0):
+        path_bytes = path.encode()
+        body = LOG_BODY.pack(op, len(path_bytes), len(data), offset)
+        body += path_bytes + data
+        with self.lock:
+            self.log.write(CRC.pack(zlib.crc32(body)) + body)
+            self.pending += 1
+            self.logged += 1
+            if self.pending >= self.group_commit_ops:
+                self.sync()
+        if self.logged >= self.snapshot_every:
+            self.snapshot()
+
+    def _flush(self):
+        """Fsync the records logged since the last sync every group_commit_seconds"""
+        while not self.closed.wait(self.group_commit_seconds):
+            with self.lock:
+                if self.pending:
+                    self.sync()
+
+    def sync(self):
+        """Make every operation so far durable"""
+        with self.lock:
+            os.fsync(self.log.fileno())
+            self.pending = 0
+
+    def mkdir(self, path: str) -> bool:
+        created = super().mkdir(path)
+        if created:
+            self._log(MKDIR, path)
+        return created
+
+    def write_file(self, path: str, data: Data) -> Optional[Data]:
+        written = super().write_file(path, data)
+        if written is not None:
+            self._log(WRITE_FILE, path, data)
+        return written
+
+    def append(self, path: str, data: Data) -> Optional[int]:
+        size = super().append(path, data)
+        if size is not None:
+            self._log(APPEND, path, data)
+        return size
+
+    def pwrite(self, path: str, data: Data, offset: int) -> Optional[int]:
+        written = super().pwrite(path, data, offset)
+        if written is not None:
+            self._log(PWRITE, path, data, offset)
+        return written
+
+    def delete(self, path: str) -> bool:
+        deleted = super().delete(path)
+        if deleted:
+            self._log(DELETE, path)
+        return deleted
+
+    # Snapshots
+
+    def snapshot(self):
+        """Write the tree to a new snapshot and start a new log"""
+        self.sync()
+        generation = self.generation + 1
+        path = self._snapshot_path()
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation))
+            self._write_tree(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        self._sync_directory()
+
+        # Logs of older generations are covered by the snapshot now
+        with self.lock:
+            self.log.close()
+            old_log = self._log_path(self.generation)
+            self.generation = generation
+            self.log = open(self._log_path(generation), "ab", buffering=0)
+            os.remove(old_log)
+            self._sync_directory()
+            self.logged = 0
+
+    def _write_tree(self, f: BinaryIO):
+        """Pre-order, a directory's entry count then its entries, each being the
+        kind, name and then either the file's data or the directory's entries"""
+        f.write(LENGTH.pack(len(self.root.children)))
+        stack = [iter(self.root.children.items())]
+        while stack:
+            for (name, node) in stack[-1]:
+                name_bytes = name.encode()
+                if isinstance(node, Dir):
+                    f.write(NAME.pack(DIR_KIND, len(name_bytes)) + name_bytes)
+                    f.write(LENGTH.pack(len(node.children)))
+                    stack.append(iter(node.children.items()))
+                    break
+                data = node.data
+                f.write(NAME.pack(FILE_KIND, len(name_bytes)) + name_bytes)
+                f.write(LENGTH.pack(len(data)))
+                f.write(data)
+            else:
+                stack.pop()
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.sync()
+        self.log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        print("\ndurable filesystem tests")
+        with DurableFileSystem(directory, snapshot_every=4) as fs:
+            p(1, fs.mkdir("/a/b"))
+            p(2, fs.write_file("/a/b/notes", b"some notes"))
+            p(3, fs.write_file("/a/b/more-notes", b"more notes"))
+            # The fourth operation writes a snapshot
+            p(4, fs.mkdir("/c"))
+            p(5, fs.delete("/a/b/notes"))
+            p(6, fs.append("/c/log", b"first line\n"))
+            p(7, fs.pwrite("/c/log", b"FIRST", 0))
+            p(8, sorted(os.listdir(directory)))
+
+        with DurableFileSystem(directory) as fs:
+            p(9, fs.to_dict())
+            p(10, fs.du("/"))
+
+        # A crash part way through appending a record
+        with open(os.path.join(directory, "log.1"), "ab") as log:
+            log.write(b"\x00\x01\x02")
+        with DurableFileSystem(directory) as fs:
+            p(11, fs.to_dict())
@@ -1,96 +1,469 @@
-from typing import Any, Dict, List, Optional
+import fnmatch
+import hashlib
+import re
+import sys
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 # Create simple filesystem commands
 
-# My failed attempt to get recursive typing to work with mypy
-# See issue: https://github.com/python/mypy/issues/731
-# T = TypeVar('T')
-# DF = Mapping[str, Union[str, T]]
-# Mapping[str, Union[str, Mapping[str, Union[str, Mapping[str, Union[str, Any]]]]]]
+# The tree is made of Dir and File nodes rather than a dictionary of
+# dictionaries so a directory and a file are told apart by their kind, not by
+# the type of a value, and write_file cannot replace a directory. Nodes use
+# __slots__ and path components are interned so millions of nodes stay small.
+# Resolving a path walks one dictionary per component, O(depth). The
+# directories of recently resolved paths can be kept in an LRU cache so
+# repeated operations in the same directory skip splitting and walking, but
+# every miss pays to insert and evict, so it is off unless path_cache_size is
+# given and only pays off when operations keep returning to a few directories.
+# Every Dir keeps the total size and number of files beneath it, updated along
+# the parent chain on each write and delete, so du is O(1) after resolution.
+# walk and glob are generators which hold one iterator per level of the tree
+# and never build a list of a directory's entries.
+# File contents are bytes. Whole contents written with write_file are stored
+# once in a ContentStore, keyed by hash and reference counted, so every path
+# holding the same data shares one bytes object. append and pwrite give the
+# file a private bytearray (copy on write) which dedupe() later shares again.
+# read returns a read only memoryview slice so no contents are copied. Views of
+# a private bytearray see later pwrites in place, like a mmap, but an append
+# which has to grow it while views are held moves it to a new bytearray.
 
-# A dictionary of dictionaries
-filestore: Dict[str, Any] = dict()
 
+class Dir:
+    __slots__ = ("children", "parent", "size", "files")
 
-def mkdir(path: str):
-    global filestore
-    leaf_dir = filestore
-    directories = [d for d in path.split("/") if d != ""]
-    for d in directories:
-        if type(leaf_dir.get(d)) == dict:
-            leaf_dir = leaf_dir[d]
+    def __init__(self, parent: Optional["Dir"] = None):
+        self.children: Dict[str, Node] = {}
+        self.parent = parent
+        self.size = 0
+        self.files = 0
+
+    def add(self, size: int, files: int):
+        """Add to the aggregates of this directory and all of its parents"""
+        leaf_dir: Optional[Dir] = self
+        while leaf_dir is not None:
+            leaf_dir.size += size
+            leaf_dir.files += files
+            leaf_dir = leaf_dir.parent
+
+
+class Blob:
+    __slots__ = ("data", "digest", "refs")
+
+    def __init__(self, data: bytes, digest: bytes):
+        self.data = data
+        self.digest = digest
+        self.refs = 0
+
+
+class File:
+    __slots__ = ("content",)
+
+    def __init__(self, content: Union[Blob, bytearray]):
+        # A Blob shared through the ContentStore or a private bytearray
+        self.content = content
+
+    @property
+    def data(self) -> Union[bytes, bytearray]:
+        content = self.content
+        return content if isinstance(content, bytearray) else content.data
+
+
+Node = Union[Dir, File]
+Data = Union[bytes, bytearray, memoryview]
+
+DIGEST_SIZE = 32
+
+
+class ContentStore:
+    """Immutable file contents stored once each. Contents shorter than a digest
+    are their own key, which is cheaper than hashing them, longer ones are keyed
+    by their 256 bit hash."""
+
+    def __init__(self):
+        self.blobs: Dict[bytes, Blob] = {}
+        # Bytes held, each blob counted once
+        self.size = 0
+
+    def add(self, data: Data) -> Blob:
+        """A reference to the blob holding data, stored if it is new"""
+        if len(data) < DIGEST_SIZE:
+            digest = data = bytes(data)
         else:
-            leaf_dir[d] = dict()
-            leaf_dir = leaf_dir[d]
-    return filestore
+            digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+        blob = self.blobs.get(digest)
+        if blob is None:
+            blob = self.blobs[digest] = Blob(bytes(data), digest)
+            self.size += len(blob.data)
+        blob.refs += 1
+        return blob
+
+    def release(self, blob: Blob):
+        blob.refs -= 1
+        if blob.refs == 0:
+            del self.blobs[blob.digest]
+            self.size -= len(blob.data)
+
+
+def split_path(path: str) -> List[str]:
+    return [d for d in path.split("/") if d != ""]
+
+
+def join_path(path: str, name: str) -> str:
+    return f"{path}/{name}" if path != "/" else f"/{name}"
+
+
+@lru_cache(maxsize=256)
+def name_matcher(pattern: str) -> Callable[[str], Any]:
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+def has_magic(part: str) -> bool:
+    return any(c in part for c in "*?[")
+
+
+class FileSystem:
+    def __init__(self, path_cache_size: int = 0):
+        self.root = Dir()
+        self.path_cache_size = path_cache_size
+        # Directory path, as given, to its Dir
+        self.path_cache: "OrderedDict[str, Dir]" = OrderedDict()
+        self.contents = ContentStore()
 
+    def _dir(self, path: str, create: bool = False) -> Optional[Dir]:
+        """Resolve the directory at path, creating missing directories if asked.
+        Returns None if it does not exist or a file is in the way."""
+        cached = self.path_cache.get(path)
+        if cached is not None:
+            self.path_cache.move_to_end(path)
+            return cached
 
-def list_files(path: str) -> Optional[List[str]]:
-    leaf_dir = filestore
-    directories = [d for d in path.split("/") if d != ""]
-    for d in directories:
-        if type(leaf_dir.get(d)) == dict:
-            leaf_dir = leaf_dir[d]
+        leaf_dir = self.root
+        for d in split_path(path):
+            child = leaf_dir.children.get(d)
+            if child is None:
+                if not create:
+                    return None
+                child = leaf_dir.children[sys.intern(d)] = Dir(leaf_dir)
+            elif not isinstance(child, Dir):
+                return None
+            leaf_dir = child
 
-    if leaf_dir:
+        if self.path_cache_size:
+            self.path_cache[path] = leaf_dir
+            if len(self.path_cache) > self.path_cache_size:
+                self.path_cache.popitem(last=False)
+        return leaf_dir
+
+    def _parent(self, path: str) -> Tuple[Optional[Dir], str]:
+        """Resolve the directory holding path and the name within it"""
+        (parent_path, _, name) = path.rstrip("/").rpartition("/")
+        if not name:
+            return (None, name)
+        return (self._dir(parent_path), name)
+
+    def mkdir(self, path: str) -> bool:
+        """Create a directory and any missing parents, False if a file is in the way"""
+        return self._dir(path, create=True) is not None
+
+    def list_files(self, path: str) -> Optional[List[str]]:
+        leaf_dir = self._dir(path)
+        if leaf_dir is None:
+            return None
         list_of_files: List[str] = []
-        for k in leaf_dir:
-            if type(leaf_dir[k]) == dict:
+        for (k, v) in leaf_dir.children.items():
+            if isinstance(v, Dir):
                 list_of_files.append(f"dir {k}")
             else:
                 list_of_files.append(f"fil {k}")
         return list_of_files
-    return None
 
+    def _file(
+        self, path: str, create: bool = False
+    ) -> Tuple[Optional[Dir], Optional[File]]:
+        """Resolve a file and its directory, an empty file is created if asked.
+        The file is None if the path is missing or is a directory."""
+        (parent, name) = self._parent(path)
+        if parent is None:
+            return (None, None)
+        node = parent.children.get(name)
+        if node is None and create:
+            node = parent.children[sys.intern(name)] = File(bytearray())
+            parent.add(0, 1)
+        if not isinstance(node, File):
+            return (parent, None)
+        return (parent, node)
+
+    def _release(self, node: Node):
+        """Drop the references a node and everything beneath it hold"""
+        if isinstance(node, File):
+            if isinstance(node.content, Blob):
+                self.contents.release(node.content)
+            return
+        for (_, child) in self._walk(node, ""):
+            if isinstance(child, File) and isinstance(child.content, Blob):
+                self.contents.release(child.content)
 
-def get_file(path: str) -> Optional[str]:
-    leaf_dir = filestore
-    directories = [d for d in path.split("/") if d != ""]
-    for d in directories:
-        if type(leaf_dir.get(d)) == dict:
-            leaf_dir = leaf_dir[d]
+    def get_file(self, path: str) -> Optional[bytes]:
+        (_, node) = self._file(path)
+        if node is None:
+            return None
+        return bytes(node.data)
+
+    def read(
+        self, path: str, offset: int = 0, length: int = -1
+    ) -> Optional[memoryview]:
+        """A read only view of length bytes from offset, to the end if length is -1"""
+        if offset < 0 or length < -1:
+            raise ValueError(f"invalid offset {offset} or length {length}")
+        (_, node) = self._file(path)
+        if node is None:
+            return None
+        view = memoryview(node.data).toreadonly()
+        return view[offset:] if length < 0 else view[offset : offset + length]
+
+    def write_file(self, path: str, data: Data) -> Optional[Data]:
+        """Write a file in an existing directory, None if the path is a directory"""
+        (parent, name) = self._parent(path)
+        if parent is None:
+            return None
+        node = parent.children.get(name)
+        if node is None:
+            parent.children[sys.intern(name)] = File(self.contents.add(data))
+            parent.add(len(data), 1)
+        elif isinstance(node, File):
+            blob = self.contents.add(data)
+            parent.add(len(data) - len(node.data), 0)
+            self._release(node)
+            node.content = blob
         else:
-            return leaf_dir.get(d)
-    return None
+            return None
+        return data
+
+    def _private(self, node: File) -> bytearray:
+        """The file's own bytearray, copied from its blob if it was shared"""
+        content = node.content
+        if isinstance(content, bytearray):
+            return content
+        private = node.content = bytearray(content.data)
+        self.contents.release(content)
+        return private
 
+    def append(self, path: str, data: Data) -> Optional[int]:
+        """Append to a file, creating it if missing, returns its new size"""
+        (parent, node) = self._file(path, create=True)
+        if parent is None or node is None:
+            return None
+        content = self._private(node)
+        try:
+            content += data
+        except BufferError:
+            # Views of it are held so it cannot grow in place
+            content = node.content = content + data
+        parent.add(len(data), 0)
+        return len(content)
 
-def write_file(path: str, data: str) -> Optional[str]:
-    leaf_dir = filestore
-    directories = [d for d in path.split("/") if d != ""]
-    for d in directories:
-        if type(leaf_dir.get(d)) == dict:
-            leaf_dir = leaf_dir[d]
+    def pwrite(self, path: str, data: Data, offset: int) -> Optional[int]:
+        """Write data at offset in a file, creating it if missing and filling any
+        gap past its end with zeros, returns the number of bytes written"""
+        if offset < 0:
+            raise ValueError(f"invalid offset {offset}")
+        (parent, node) = self._file(path, create=True)
+        if parent is None or node is None:
+            return None
+        content = self._private(node)
+        size = len(content)
+        end = offset + len(data)
+        if end > size:
+            try:
+                content.extend(bytes(end - size))
+            except BufferError:
+                content = node.content = content + bytes(end - size)
+            parent.add(end - size, 0)
+        content[offset:end] = data
+        return len(data)
+
+    def dedupe(self) -> int:
+        """Share the contents of files made private by append and pwrite, returns
+        how many were shared"""
+        shared = 0
+        for (_, node) in self._walk(self.root, ""):
+            if isinstance(node, File) and isinstance(node.content, bytearray):
+                node.content = self.contents.add(node.content)
+                shared += 1
+        return shared
+
+    def delete(self, path: str) -> bool:
+        """Delete a file or a directory and everything beneath it"""
+        (parent, name) = self._parent(path)
+        if parent is None or name not in parent.children:
+            return False
+        node = parent.children.pop(name)
+        self._release(node)
+        if isinstance(node, Dir):
+            parent.add(-node.size, -node.files)
+            node.parent = None
+            # Cached paths may be inside the deleted directory
+            self.path_cache.clear()
         else:
-            leaf_dir[d] = data
-            return data
-    return None
+            parent.add(-len(node.data), -1)
+        return True
+
+    def du(self, path: str) -> Optional[Tuple[int, int]]:
+        """The total size and number of files at or beneath path"""
+        leaf_dir = self._dir(path)
+        if leaf_dir is not None:
+            return (leaf_dir.size, leaf_dir.files)
+        (_, node) = self._file(path)
+        if node is not None:
+            return (len(node.data), 1)
+        return None
+
+    def _walk(self, leaf_dir: Dir, path: str) -> Iterator[Tuple[str, Node]]:
+        """Depth first, parents before children. Only one iterator per level and
+        the current directory's path are held so memory is O(depth), not O(depth²)"""
+        dir_path = path.rstrip("/")
+        stack = [iter(leaf_dir.children.items())]
+        while stack:
+            for (name, node) in stack[-1]:
+                entry_path = f"{dir_path}/{name}"
+                yield (entry_path, node)
+                if isinstance(node, Dir):
+                    dir_path = entry_path
+                    stack.append(iter(node.children.items()))
+                    break
+            else:
+                stack.pop()
+                dir_path = dir_path.rpartition("/")[0]
+
+    def walk(self, path: str = "/") -> Iterator[str]:
+        """Lazily yield every entry beneath path as "dir <path>" or "fil <path>" """
+        leaf_dir = self._dir(path)
+        if leaf_dir is None:
+            return
+        root = "/" + "/".join(split_path(path))
+        for (entry_path, node) in self._walk(leaf_dir, root):
+            yield f"dir {entry_path}" if isinstance(node, Dir) else f"fil {entry_path}"
+
+    def glob(self, pattern: str) -> Iterator[str]:
+        """Lazily yield the paths matching a pattern of fnmatch style components
+        where ** matches any number of directories, e.g. /a/**/*.txt"""
+        parts = split_path(pattern)
+        if parts:
+            yield from self._glob(self.root, "/", parts)
+
+    def _glob(self, leaf_dir: Dir, path: str, parts: List[str]) -> Iterator[str]:
+        (part, rest) = (parts[0], parts[1:])
+        if part == "**":
+            if not rest:
+                yield from (p for (p, _) in self._walk(leaf_dir, path))
+                return
+            yield from self._glob(leaf_dir, path, rest)
+            for (dir_path, node) in self._walk(leaf_dir, path):
+                if isinstance(node, Dir):
+                    yield from self._glob(node, dir_path, rest)
+            return
+
+        if has_magic(part):
+            match = name_matcher(part)
+            entries: Any = (
+                (name, node)
+                for (name, node) in leaf_dir.children.items()
+                if match(name)
+            )
+        else:
+            child = leaf_dir.children.get(part)
+            entries = [(part, child)] if child is not None else []
+        for (name, node) in entries:
+            entry_path = join_path(path, name)
+            if not rest:
+                yield entry_path
+            elif isinstance(node, Dir):
+                yield from self._glob(node, entry_path, rest)
+
+    def to_dict(self, leaf_dir: Optional[Dir] = None) -> Dict[str, Any]:
+        """The tree as a dictionary of dictionaries, handy for printing"""
+        leaf_dir = leaf_dir or self.root
+        return {
+            k: self.to_dict(v) if isinstance(v, Dir) else bytes(v.data)
+            for (k, v) in leaf_dir.children.items()
+        }
 
 
 def p(i: int, thing: Any):
     print(f"{i} {thing}")
 
 
-# Manual tests
-print("\nmkdir and list_file tests")
-p(1, mkdir("/"))
-p(2, mkdir("/a"))
-p(3, list_files("/"))
-p(4, mkdir("/a/b"))
-p(5, list_files("/a"))
-p(6, mkdir("/a/b/c"))
-p(7, mkdir("/a/b/c/d/e/f/g"))
-p(8, list_files("/a/b/c"))
-p(9, list_files("/a/b/c/d"))
-
-# File tests
-print("\nwrite_file get_file list_file tests")
-p(1, write_file("/a/b/c", "c-stuff"))
-p(2, write_file("/a/b/c/d/e", "e-stuff"))
-
-p(3, write_file("/a/b/c/d-file", "d-things"))
-p(4, get_file("/a/b/c/d-file"))
-p(5, list_files("/a/b/c"))
-
-p(6, get_file("/a/b/c/d/e"))
-p(7, get_file("/a/b/c/d"))
-p(8, get_file("/a/b/c"))
+if __name__ == "__main__":
+    fs = FileSystem()
+
+    # Manual tests
+    print("\nmkdir and list_file tests")
+    p(1, fs.mkdir("/"))
+    p(2, fs.mkdir("/a"))
+    p(3, fs.list_files("/"))
+    p(4, fs.mkdir("/a/b"))
+    p(5, fs.list_files("/a"))
+    p(6, fs.mkdir("/a/b/c"))
+    p(7, fs.mkdir("/a/b/c/d/e/f/g"))
+    p(8, fs.list_files("/a/b/c"))
+    p(9, fs.list_files("/a/b/c/d"))
+    p(10, fs.to_dict())
+
+    # File tests
+    print("\nwrite_file get_file list_file tests")
+    p(1, fs.write_file("/a/b/c", b"c-stuff"))
+    p(2, fs.write_file("/a/b/c/d/e", b"e-stuff"))
+
+    p(3, fs.write_file("/a/b/c/d-file", b"d-things"))
+    p(4, fs.get_file("/a/b/c/d-file"))
+    p(5, fs.list_files("/a/b/c"))
+
+    p(6, fs.get_file("/a/b/c/d/e"))
+    p(7, fs.get_file("/a/b/c/d"))
+    p(8, fs.get_file("/a/b/c"))
+    p(9, fs.mkdir("/a/b/c/d-file/x"))
+    p(10, fs.to_dict())
+
+    # Independent instances
+    print("\nmultiple filesystem tests")
+    other = FileSystem(path_cache_size=0)
+    p(1, other.write_file("/a", b"other-a"))
+    p(2, other.list_files("/"))
+    p(3, fs.list_files("/"))
+
+    # walk, glob, du and delete tests
+    print("\nwalk glob du delete tests")
+    p(1, list(fs.walk("/a/b/c")))
+    p(2, list(fs.glob("/a/*/c/*")))
+    p(3, list(fs.glob("/**/g")))
+    p(4, fs.write_file("/a/b/c/d/e/notes.txt", b"0123456789"))
+    p(5, fs.du("/"))
+    p(6, fs.du("/a/b/c/d"))
+    p(7, fs.delete("/a/b/c/d"))
+    p(8, fs.du("/"))
+    p(9, fs.list_files("/a/b/c"))
+
+    # bytes, ranged reads, partial writes and deduplication tests
+    print("\nread append pwrite dedupe tests")
+    p(1, fs.write_file("/a/one", b"same contents"))
+    p(2, fs.write_file("/a/two", b"same contents"))
+    p(3, (len(fs.contents.blobs), fs.contents.size))
+    view = fs.read("/a/one", 5, 3)
+    p(4, (view.readonly, bytes(view)) if view is not None else None)
+    p(5, fs.append("/a/two", b", now different"))
+    p(6, fs.get_file("/a/two"))
+    p(7, fs.pwrite("/a/two", b"SAME", 0))
+    p(8, fs.pwrite("/a/sparse", b"end", 4))
+    p(9, fs.get_file("/a/sparse"))
+    p(10, fs.du("/a"))
+    p(11, fs.write_file("/a/two", b"same contents"))
+    p(12, (len(fs.contents.blobs), fs.contents.size))
+    p(13, fs.dedupe())
+    p(14, fs.delete("/a"))
+    p(15, (len(fs.contents.blobs), fs.contents.size))
+    try:
+        fs.pwrite("/negative", b"x", -1)
+    except ValueError as e:
+        p(16, (e, fs.get_file("/negative")))
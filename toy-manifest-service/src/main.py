@@ -3,13 +3,16 @@ import logging
 
 from aiohttp import web
 
-from toy_manifest_service import schema, settings, views
+from toy_manifest_service import blobcache, profiling, schema, settings, views
 
 logging.basicConfig(level=logging.INFO)
 
-app = web.Application()
+app = web.Application(middlewares=[profiling.timing_middleware])
 app.add_routes(views.routes)
 app.cleanup_ctx.append(schema.conn_pool)
+app[profiling.TIMING_CONFIG] = profiling.TimingConfig()
+if settings.BLOB_CACHE_ENABLED:
+    app[blobcache.BLOB_CACHE] = blobcache.BlobCache()
 
 logging.info(f"Starting Toy Manifest Service on port {settings.PORT}")
 web.run_app(app, port=settings.PORT)
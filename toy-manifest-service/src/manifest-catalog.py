@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import logging
+import sys
+from datetime import datetime, timezone
+
+import asyncpg
+
+from toy_manifest_service import catalog
+
+# Export or import the manifest catalog as newline delimited JSON
+# Connection details come from the PG* environment variables e.g.
+#   python manifest-catalog.py export > manifests.ndjson
+#   python manifest-catalog.py import --checkpoint import.ckpt manifests.ndjson
+
+logging.basicConfig(level=logging.INFO)
+
+
+def timestamp(value: str) -> datetime:
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+
+async def export_catalog(args):
+    conn = await asyncpg.connect()
+    try:
+        count = await catalog.export_manifests(
+            conn, sys.stdout, args.since, args.until, prefetch=args.prefetch
+        )
+    finally:
+        await conn.close()
+    logging.info(f"Exported {count} manifests")
+
+
+async def import_catalog(args):
+    async with asyncpg.create_pool(
+        min_size=args.concurrency, max_size=args.concurrency, command_timeout=None
+    ) as pool:
+        with open(args.file) as lines:
+            (imported, rejected) = await catalog.import_manifests(
+                pool,
+                lines,
+                batch_size=args.batch_size,
+                concurrency=args.concurrency,
+                checkpoint=catalog.Checkpoint(args.checkpoint),
+            )
+    logging.info(f"Imported {imported} manifests, rejected {rejected}")
+
+
+parser = argparse.ArgumentParser(description="Export or import the manifest catalog")
+commands = parser.add_subparsers(dest="command", required=True)
+
+export_parser = commands.add_parser("export", help="write manifests to stdout")
+export_parser.add_argument(
+    "--since", type=timestamp, default=datetime(1970, 1, 1, tzinfo=timezone.utc)
+)
+export_parser.add_argument(
+    "--until", type=timestamp, default=datetime(9999, 1, 1, tzinfo=timezone.utc)
+)
+export_parser.add_argument("--prefetch", type=int, default=1000)
+export_parser.set_defaults(run=export_catalog)
+
+import_parser = commands.add_parser("import", help="load manifests from a file")
+import_parser.add_argument("file")
+import_parser.add_argument("--batch-size", type=int, default=5000)
+import_parser.add_argument("--concurrency", type=int, default=4)
+import_parser.add_argument(
+    "--checkpoint", help="file recording progress, an existing one is resumed"
+)
+import_parser.set_defaults(run=import_catalog)
+
+args = parser.parse_args()
+asyncio.run(args.run(args))
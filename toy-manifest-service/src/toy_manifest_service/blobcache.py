@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import mmap
+import os
+from array import array
+from typing import Callable, Dict, Optional, Tuple, Union
+
+from . import settings
+
+# Tiered read cache for the layer blobs in LAYERS_DIR
+# A few base layers account for most pulls, so rather than every pull going
+# through the filesystem (competing with upload writes for the page cache)
+#   - small hot blobs are held in memory as bytes, under a byte budget
+#   - larger hot blobs are mmap'd, under a separate mapped byte budget
+# Both are served as memoryview slices so Range reads copy nothing.
+# Frequencies come from a TinyLFU style count-min sketch which sees every
+# request, cached or not. A blob is only admitted once it has been asked for
+# min_admit_frequency times, so one-off cold pulls never displace hot blobs,
+# and only by evicting blobs of its tier with a lower frequency.
+
+log = logging.getLogger(__name__)
+
+BLOB_CACHE = "blob_cache"
+
+MEMORY = "memory"
+MMAP = "mmap"
+DISK = "disk"
+
+
+class FrequencySketch:
+    """Count-min sketch of access frequencies with periodic halving (aging)
+    so blobs that were hot a while ago do not stay hot forever."""
+
+    def __init__(self, width: int = 4096, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("L", [0]) * width for _ in range(depth)]
+        self.additions = 0
+        self.sample_size = width * 10
+
+    def _indexes(self, key: str):
+        # One independent 32 bit hash per row from a single blake2b digest,
+        # rather than hash() whose results depend on PYTHONHASHSEED
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        return (
+            (row, int.from_bytes(digest[4 * row : 4 * row + 4], "little") % self.width)
+            for row in range(self.depth)
+        )
+
+    def increment(self, key: str):
+        for (row, i) in self._indexes(key):
+            self.rows[row][i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.additions //= 2
+            for counters in self.rows:
+                for i in range(self.width):
+                    counters[i] >>= 1
+
+    def estimate(self, key: str) -> int:
+        return min(self.rows[row][i] for (row, i) in self._indexes(key))
+
+
+class CachedBlob:
+    __slots__ = ("data", "size", "tier")
+
+    def __init__(self, data, size: int, tier: str):
+        # bytes for the memory tier, mmap.mmap for the mmap tier
+        self.data = data
+        self.size = size
+        self.tier = tier
+
+
+def read_blob(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def map_blob(path: str) -> mmap.mmap:
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobCache:
+    def __init__(
+        self,
+        memory_budget: int = settings.BLOB_CACHE_MEMORY_BYTES,
+        mmap_budget: int = settings.BLOB_CACHE_MMAP_BYTES,
+        small_blob_max: int = settings.BLOB_CACHE_SMALL_BLOB_BYTES,
+        min_admit_frequency: int = 2,
+    ):
+        self.budgets = {MEMORY: memory_budget, MMAP: mmap_budget}
+        self.used = {MEMORY: 0, MMAP: 0}
+        self.small_blob_max = small_blob_max
+        self.min_admit_frequency = min_admit_frequency
+        self.sketch = FrequencySketch()
+        self.blobs: Dict[str, CachedBlob] = {}
+        # Path to the token of the load reserving its space. invalidate drops
+        # the token so a load started before it cannot cache what it read.
+        self.loading: Dict[str, int] = {}
+        self.tokens = itertools.count()
+        self.hits = {MEMORY: 0, MMAP: 0, DISK: 0}
+        self.bytes_served = {MEMORY: 0, MMAP: 0, DISK: 0}
+
+    async def get(self, path: str) -> Optional[Tuple[memoryview, str]]:
+        """Return a view of the blob and its tier, or None if it should be read from disk
+        Raises FileNotFoundError when there is no such blob."""
+        self.sketch.increment(path)
+        blob = self.blobs.get(path)
+        if blob:
+            self.hits[blob.tier] += 1
+            return (memoryview(blob.data), blob.tier)
+
+        size = os.stat(path).st_size
+        tier = MEMORY if size <= self.small_blob_max else MMAP
+        if not size or path in self.loading or not self._make_room(path, size, tier):
+            self.hits[DISK] += 1
+            return None
+
+        # Reserve the space while the blob is read so concurrent admissions
+        # cannot overrun the budget
+        token = next(self.tokens)
+        self.loading[path] = token
+        self.used[tier] += size
+        try:
+            loader: Callable[[str], Union[bytes, mmap.mmap]] = (
+                read_blob if tier == MEMORY else map_blob
+            )
+            data = await asyncio.get_running_loop().run_in_executor(None, loader, path)
+        except Exception:
+            self._end_load(path, token)
+            self.used[tier] -= size
+            raise
+        if not self._end_load(path, token):
+            # Invalidated while it was being read, serve it this once
+            self.used[tier] -= size
+            self.hits[tier] += 1
+            return (memoryview(data), tier)
+        blob = CachedBlob(data, size, tier)
+        self.blobs[path] = blob
+        log.info(f"Cached {size} byte blob {path} in {tier}")
+        self.hits[tier] += 1
+        return (memoryview(blob.data), tier)
+
+    def _end_load(self, path: str, token: int) -> bool:
+        """Finish a load, False if it was invalidated since it started"""
+        if self.loading.get(path) != token:
+            return False
+        del self.loading[path]
+        return True
+
+    def _make_room(self, path: str, size: int, tier: str) -> bool:
+        """Evict colder blobs of the tier to admit path, returns False to reject it"""
+        frequency = self.sketch.estimate(path)
+        if frequency < self.min_admit_frequency or size > self.budgets[tier]:
+            return False
+        candidates = sorted(
+            (self.sketch.estimate(p), p)
+            for (p, b) in self.blobs.items()
+            if b.tier == tier
+        )
+        free = self.budgets[tier] - self.used[tier]
+        victims = []
+        for (victim_frequency, victim) in candidates:
+            if free >= size:
+                break
+            if victim_frequency >= frequency:
+                return False
+            victims.append(victim)
+            free += self.blobs[victim].size
+        if free < size:
+            return False
+        for victim in victims:
+            self.invalidate(victim)
+        return True
+
+    def invalidate(self, path: str):
+        """Drop a blob, e.g. because it is being replaced. A mmap still being
+        served is closed once the last memoryview of it is released."""
+        self.loading.pop(path, None)
+        blob = self.blobs.pop(path, None)
+        if blob:
+            self.used[blob.tier] -= blob.size
+
+    def clear(self):
+        for path in list(self.blobs) + list(self.loading):
+            self.invalidate(path)
+
+    def served(self, tier: str, num_bytes: int):
+        self.bytes_served[tier] += num_bytes
+
+    def stats(self) -> Dict:
+        requests = sum(self.hits.values())
+        return {
+            "blobs": len(self.blobs),
+            "hit_ratio": (requests - self.hits[DISK]) / requests if requests else 0.0,
+            "requests": dict(self.hits),
+            "bytes_served": dict(self.bytes_served),
+            "bytes_used": dict(self.used),
+            "bytes_budget": dict(self.budgets),
+        }
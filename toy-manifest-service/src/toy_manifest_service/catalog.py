@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime
+from typing import IO, Any, List, Optional, Set, Tuple, cast
+
+import asyncpg
+
+from .schema import (
+    MANIFEST_LAYER_INSERT_COLUMNS,
+    build_manifest,
+    manifest_layer_records,
+    select_manifests,
+)
+
+# Bulk export and import of the manifest catalog
+# The export is newline delimited JSON, one OCI manifest per line, the same
+# format streamed by GET /manifests plus a "ts" key holding when it was pushed.
+# Import validates each line with build_manifest and loads whole manifests in
+# batches with COPY (via copy_records_to_table) so the cost is one round trip
+# per batch, not per layer. Rows keep the ts of the line, so they land in their
+# original partitions, and lines without one take the time of the import. The
+# target needs partitions covering the exported range.
+# The checkpoint is saved after a batch commits, so a crash in between re-runs
+# the batch. Batches are COPY'd into a temporary table and inserted from there
+# with ON CONFLICT DO NOTHING so the rows already loaded are skipped.
+
+log = logging.getLogger(__name__)
+
+
+async def export_manifests(
+    conn: asyncpg.connection.Connection,
+    out: IO[str],
+    since: datetime,
+    until: datetime,
+    prefetch: int = 1000,
+) -> int:
+    """Write every manifest pushed in [since, until) to out, returns the count"""
+    count = 0
+    manifests = select_manifests(conn, since, until, prefetch=prefetch)
+    try:
+        async for (ts, manifest) in manifests:
+            out.write(json.dumps({**manifest, "ts": ts.isoformat()}))
+            out.write("\n")
+            count += 1
+            if count % 100000 == 0:
+                log.info(f"Exported {count} manifests")
+    finally:
+        # Ends its transaction if writing failed part way
+        await manifests.aclose()
+    return count
+
+
+class Checkpoint:
+    """Tracks which input lines have been committed so an import can resume.
+    Batches commit out of order when run concurrently so besides the contiguous
+    line watermark the line ranges of batches committed past it are kept too."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.line = 0
+        self.done: List[Tuple[int, int]] = []
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.line = state["line"]
+            self.done = [(start, end) for start, end in state["done"]]
+            log.info(f"Resuming import after line {self.line} from {path}")
+
+    def skip(self, line: int) -> bool:
+        """True if the line was committed by a previous run"""
+        return line < self.line or any(start <= line < end for start, end in self.done)
+
+    def commit(self, start: int, end: int):
+        """Record lines [start, end) as committed and persist the checkpoint"""
+        self.done.append((start, end))
+        self.done.sort()
+        while self.done and self.done[0][0] <= self.line:
+            self.line = max(self.line, self.done.pop(0)[1])
+        if self.path:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"line": self.line, "done": self.done}, f)
+            os.replace(tmp_path, self.path)
+
+
+def pop_pushed(manifest_json: Any) -> Optional[datetime]:
+    """Remove and parse the ts an exported manifest was pushed at, if it has one"""
+    if not isinstance(manifest_json, dict) or manifest_json.get("ts") is None:
+        return None
+    return datetime.fromisoformat(manifest_json.pop("ts"))
+
+
+async def copy_batch(
+    pool: asyncpg.pool.Pool,
+    records: List[Tuple],
+    start: int,
+    end: int,
+    checkpoint: Checkpoint,
+):
+    columns = ", ".join(MANIFEST_LAYER_INSERT_COLUMNS)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                "CREATE TEMPORARY TABLE import_batch (LIKE manifest_layers) ON COMMIT DROP"
+            )
+            await conn.copy_records_to_table(
+                "import_batch",
+                records=records,
+                columns=MANIFEST_LAYER_INSERT_COLUMNS + ("ts",),
+            )
+            await conn.execute(
+                f"""INSERT INTO manifest_layers ({columns}, ts)
+            SELECT {columns}, COALESCE(ts, NOW()) FROM import_batch
+            ON CONFLICT DO NOTHING
+            """
+            )
+    checkpoint.commit(start, end)
+    log.info(f"Imported lines {start} to {end} ({len(records)} layers)")
+
+
+async def import_manifests(
+    pool: asyncpg.pool.Pool,
+    lines: IO[str],
+    batch_size: int = 5000,
+    concurrency: int = 4,
+    checkpoint: Optional[Checkpoint] = None,
+) -> Tuple[int, int]:
+    """Import NDJSON manifests, returns the counts of imported and rejected manifests
+    batch_size is the number of layer rows per COPY and concurrency the number of
+    COPYs in flight. Rows take the ts of the import like a POST /manifest would."""
+    checkpoint = checkpoint or Checkpoint(None)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: Set[asyncio.Task] = set()
+    failures: List[BaseException] = []
+    records: List[Tuple] = []
+    start = 0
+    imported = 0
+    rejected = 0
+
+    def batch_done(task: asyncio.Task):
+        tasks.discard(task)
+        semaphore.release()
+        if not task.cancelled() and task.exception():
+            failures.append(cast(BaseException, task.exception()))
+
+    async def flush(end: int):
+        nonlocal records, start
+        if records:
+            await semaphore.acquire()
+            task = asyncio.create_task(
+                copy_batch(pool, records, start, end, checkpoint)
+            )
+            tasks.add(task)
+            task.add_done_callback(batch_done)
+        records = []
+        start = end
+
+    line_number = 0
+    try:
+        for line_number, line in enumerate(lines):
+            # Fail fast rather than keep queueing behind a failed batch
+            if failures:
+                raise failures[0]
+            if checkpoint.skip(line_number):
+                await flush(line_number + 1)
+                continue
+            if not line.strip():
+                continue
+            try:
+                manifest_json = json.loads(line)
+                pushed = pop_pushed(manifest_json)
+            except (TypeError, ValueError) as e:
+                log.error(f"Rejected line {line_number}, invalid JSON or ts {e}")
+                rejected += 1
+                continue
+            (manifest, error) = build_manifest(manifest_json)
+            if error or not manifest:
+                log.error(f"Rejected line {line_number}, invalid manifest {error}")
+                rejected += 1
+                continue
+            records.extend(
+                record + (pushed,) for record in manifest_layer_records(manifest)
+            )
+            imported += 1
+            if len(records) >= batch_size:
+                await flush(line_number + 1)
+
+        await flush(line_number + 1)
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        # No batch is left running behind a failure
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if failures:
+        raise failures[0]
+    return (imported, rejected)
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional, Union
+
+import asyncpg
+
+from . import settings
+from .replica import current_lsn, parse_lsn
+
+# Cross instance cache invalidation with Postgres LISTEN/NOTIFY
+# Writers publish "<kind>:<key>" on CHANNEL in the same transaction as the
+# write, Postgres only delivers a notification once its transaction commits.
+# Every instance keeps one dedicated connection listening on CHANNEL and hands
+# each key to the invalidation handler registered for its kind. Notifications
+# sent while that connection is down are lost so on every (re)connect all
+# caches are reset instead.
+# A replica may not have replayed an invalidated write yet, so after
+# notifications and on (re)connect the listener reads the primary's WAL
+# position, which every invalidation received so far had committed by. A read
+# from the replica only fills a cache once the replica has replayed past it.
+# Notifications arriving during a read are covered by one more read after it,
+# so a burst of writes costs two reads rather than one per write.
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "toy_manifest_invalidate"
+MANIFEST = "manifest"
+LAYER = "layer"
+
+
+async def publish(
+    conn: Union[asyncpg.connection.Connection, asyncpg.pool.Pool], kind: str, key: str
+):
+    await conn.execute("SELECT pg_notify($1, $2)", CHANNEL, f"{kind}:{key}")
+
+
+class InvalidationListener:
+    def __init__(self) -> None:
+        self.handlers: Dict[str, Callable[[str], None]] = {}
+        self.resets: List[Callable[[], None]] = []
+        self.connected = asyncio.Event()
+        self.conn: Optional[asyncpg.connection.Connection] = None
+        # The connection runs one query at a time
+        self.lock = asyncio.Lock()
+        # None while unknown, i.e. disconnected or a read is due
+        self.invalidated_lsn: Optional[int] = None
+        # Set when notifications arrived since the last read began
+        self.lsn_stale = False
+        self.lsn_reader: Optional[asyncio.Task] = None
+
+    def on(self, kind: str, handler: Callable[[str], None]):
+        """Call handler with the key of each invalidation of this kind"""
+        self.handlers[kind] = handler
+
+    def on_reset(self, reset: Callable[[], None]):
+        """Call reset whenever invalidations may have been missed"""
+        self.resets.append(reset)
+
+    def reset(self) -> None:
+        for reset in self.resets:
+            reset()
+
+    def notified(self, conn, pid: int, channel: str, payload: str):
+        (kind, _, key) = payload.partition(":")
+        handler = self.handlers.get(kind)
+        if handler:
+            handler(key)
+        else:
+            log.warning(f"Ignoring invalidation {payload} from {pid}")
+        self.refresh_lsn()
+
+    def refresh_lsn(self) -> None:
+        """Re-read the primary's WAL position, after the read in flight if any"""
+        self.invalidated_lsn = None
+        self.lsn_stale = True
+        if self.lsn_reader is None or self.lsn_reader.done():
+            self.lsn_reader = asyncio.ensure_future(self.read_lsn())
+
+    async def read_lsn(self) -> None:
+        """Read the WAL position until a read began after the last notification"""
+        while self.lsn_stale and self.conn is not None:
+            conn = self.conn
+            self.lsn_stale = False
+            try:
+                async with self.lock:
+                    lsn = parse_lsn(await current_lsn(conn))
+            except Exception as e:
+                log.warning(f"Reading the WAL position failed {e}")
+                return
+            if conn is self.conn and not self.lsn_stale:
+                self.invalidated_lsn = lsn
+
+    def replica_current(self, replay_lsn: Optional[int]) -> bool:
+        """Whether a replica which has replayed up to replay_lsn has every write
+        invalidated so far"""
+        return (
+            replay_lsn is not None
+            and self.invalidated_lsn is not None
+            and replay_lsn >= self.invalidated_lsn
+        )
+
+    async def run(self) -> None:
+        """Listen until cancelled, reconnecting with backoff when the connection is lost"""
+        backoff = 1.0
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect()
+                lost = asyncio.Event()
+                conn.add_termination_listener(lambda c, lost=lost: lost.set())
+                self.conn = conn
+                await conn.add_listener(CHANNEL, self.notified)
+                self.refresh_lsn()
+                self.reset()
+                self.connected.set()
+                log.info(f"Listening for cache invalidations on {CHANNEL}")
+                backoff = 1.0
+                # A connection dropped without a FIN is only noticed on I/O
+                while not lost.is_set():
+                    try:
+                        await asyncio.wait_for(
+                            lost.wait(), settings.LISTENER_PING_SECONDS
+                        )
+                    except asyncio.TimeoutError:
+                        async with self.lock:
+                            await conn.fetchval(
+                                "SELECT 1", timeout=settings.LISTENER_PING_SECONDS
+                            )
+                log.warning("Invalidation listener connection lost")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Invalidation listener failed {e}")
+            finally:
+                self.connected.clear()
+                self.conn = None
+                self.invalidated_lsn = None
+                if conn is not None and not conn.is_closed():
+                    conn.terminate()
+            self.reset()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
@@ -0,0 +1,141 @@
+import logging
+import sys
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    TypeVar,
+)
+
+import asyncpg
+from aiohttp import web
+
+from . import settings
+
+# Opt-in request instrumentation
+# When enabled the timing middleware gives each request a RequestTimings which
+# handlers use to time their phases (acquire, parse, query, hash, write). Slow
+# requests are logged with the breakdown. When disabled handlers are handed
+# NULL_TIMINGS whose phase() is a shared nullcontext so the cost is negligible.
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+TIMING_CONFIG = "timing_config"
+REQUEST_TIMINGS = "timings"
+
+
+class TimingConfig:
+    """Live toggled instrumentation settings stored on the application"""
+
+    def __init__(
+        self,
+        enabled: bool = settings.TIMING_ENABLED,
+        slow_request_ms: float = settings.SLOW_REQUEST_MS,
+    ):
+        self.enabled = enabled
+        self.slow_request_ms = slow_request_ms
+        self.profiling = False
+
+
+class RequestTimings:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.phases: Dict[str, float] = {}
+
+    def phase(self, name: str) -> ContextManager[None]:
+        """Add the time spent in the block to the named phase, in seconds"""
+        if not self.enabled:
+            return NULL_PHASE
+        return self._timed(name)
+
+    async def timed(self, name: str, awaitable: Awaitable[T]) -> T:
+        """Await the awaitable, adding the time taken to the named phase"""
+        with self.phase(name):
+            return await awaitable
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (
+                time.perf_counter() - start
+            )
+
+    def breakdown(self) -> str:
+        return " ".join(f"{k}={v * 1000:.1f}ms" for (k, v) in self.phases.items())
+
+
+NULL_PHASE: ContextManager[None] = nullcontext()
+NULL_TIMINGS = RequestTimings(enabled=False)
+
+
+def request_timings(request: web.Request) -> RequestTimings:
+    return request.get(REQUEST_TIMINGS, NULL_TIMINGS)
+
+
+@asynccontextmanager
+async def acquire(
+    pool: asyncpg.pool.Pool, timings: RequestTimings
+) -> AsyncIterator[asyncpg.connection.Connection]:
+    """pool.acquire() which records the wait as the acquire phase"""
+    with timings.phase("acquire"):
+        conn = await pool.acquire()
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+@web.middleware
+async def timing_middleware(
+    request: web.Request,
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    config = request.app.get(TIMING_CONFIG)
+    if config is None or not config.enabled:
+        return await handler(request)
+
+    timings = RequestTimings()
+    request[REQUEST_TIMINGS] = timings
+    start = time.perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms >= config.slow_request_ms:
+            log.warning(
+                f"Slow request {request.method} {request.path} took {elapsed_ms:.1f}ms {timings.breakdown()}"
+            )
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Counter:
+    """Sample the stack of a thread every interval seconds for the given duration
+    Returns a Counter of collapsed stacks, root first and separated by ;"""
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if names:
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    """Format stacks in the collapsed format read by flamegraph.pl and speedscope"""
+    return "".join(f"{stack} {count}\n" for (stack, count) in stacks.most_common())
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+
+from . import settings
+
+# Read replica routing
+# Reads go to the replica pool while its health check passes, i.e. it answers
+# and its replay lag is within REPLICA_MAX_LAG_SECONDS, otherwise they fall back
+# to the primary. For read-your-writes a writer is handed the primary's WAL
+# position (LSN) after commit and reads presenting it only use the replica once
+# the replica has replayed past that position.
+
+log = logging.getLogger(__name__)
+
+# Cookie carrying the LSN of a client's last write
+LSN_COOKIE = "pg_lsn"
+
+
+def parse_lsn(lsn: Optional[str]) -> Optional[int]:
+    """Convert a Postgres LSN e.g. 16/B374D848 into a comparable int"""
+    if not lsn:
+        return None
+    try:
+        (high, low) = lsn.split("/")
+        return (int(high, 16) << 32) | int(low, 16)
+    except ValueError:
+        return None
+
+
+async def current_lsn(conn: asyncpg.connection.Connection) -> str:
+    """The primary's WAL position, read after a commit for read-your-writes"""
+    return await conn.fetchval("SELECT pg_current_wal_lsn()::text")
+
+
+class ReadRouter:
+    def __init__(
+        self,
+        primary: asyncpg.pool.Pool,
+        replica: Optional[asyncpg.pool.Pool] = None,
+        max_lag_seconds: float = settings.REPLICA_MAX_LAG_SECONDS,
+    ):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag_seconds = max_lag_seconds
+        self.healthy = False
+        self.replay_lsn: Optional[int] = None
+
+    def pool(self, min_lsn: Optional[int] = None) -> asyncpg.pool.Pool:
+        """The pool to read from, min_lsn is the position a read must observe"""
+        if self.replica is None or not self.healthy:
+            return self.primary
+        if min_lsn is not None and (
+            self.replay_lsn is None or self.replay_lsn < min_lsn
+        ):
+            return self.primary
+        return self.replica
+
+    async def check(self) -> None:
+        """Update the replica's health from its replay lag and position
+        A replica with nothing left to replay has no lag however old its last
+        replayed transaction is. A server which is not a standby has no replay
+        position, it is still used for reads but never for read-your-writes."""
+        if self.replica is None:
+            return
+        try:
+            row = await self.replica.fetchrow(
+                """SELECT
+            CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+            END AS lag,
+            pg_last_wal_replay_lsn()::text AS replay_lsn
+            """,
+                timeout=settings.REPLICA_CHECK_INTERVAL_SECONDS,
+            )
+            lag = float(row["lag"] or 0)
+            healthy = lag <= self.max_lag_seconds
+            self.replay_lsn = parse_lsn(row["replay_lsn"])
+            if not healthy:
+                log.warning(f"Replica lag {lag}s exceeds {self.max_lag_seconds}s")
+        except Exception as e:
+            log.warning(f"Replica health check failed {e}")
+            healthy = False
+        if healthy != self.healthy:
+            log.info(f"Replica reads {'enabled' if healthy else 'disabled'}")
+        self.healthy = healthy
+
+    async def monitor(self) -> None:
+        while True:
+            await self.check()
+            await asyncio.sleep(settings.REPLICA_CHECK_INTERVAL_SECONDS)
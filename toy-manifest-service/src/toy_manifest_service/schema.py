@@ -1,8 +1,12 @@
+import asyncio
 import json
 import logging
+import os
 import urllib.parse as url
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 from typing import (
+    AsyncGenerator,
+    Iterator,
     List,
     Mapping,
     Optional,
@@ -17,6 +21,12 @@ from typing import (
 
 import asyncpg
 
+from . import settings
+from .blobcache import BLOB_CACHE
+from .cache import TTLCache
+from .listener import LAYER, MANIFEST, InvalidationListener, publish
+from .replica import ReadRouter
+
 # Single table Postgres schema (version 13)
 # De-normalized per layer, Annotations JSONB
 # where urls_json = {
@@ -262,16 +272,47 @@ def create_json(manifest: OCIManifest, layer: OCIContentDescriptor) -> Tuple[str
     return (annotations_json, urls_json)
 
 
+# Columns written per layer, in the order of the manifest_layer_records tuples
+MANIFEST_LAYER_INSERT_COLUMNS = (
+    "annotations",
+    "digest",
+    "media_type",
+    "layer_order",
+    "layer_size",
+    "urls",
+    "manifest_config_digest",
+    "manifest_config_media_type",
+    "manifest_config_size",
+    "manifest_media_type",
+    "manifest_schema_version",
+)
+
+
+def manifest_layer_records(manifest: OCIManifest) -> Iterator[Tuple]:
+    """Yield one manifest_layers row per layer, see MANIFEST_LAYER_INSERT_COLUMNS"""
+    manifest_config = manifest["config"]
+    for layer_order, layer in enumerate(manifest["layers"]):
+        annotations_json, urls_json = create_json(manifest, layer)
+        yield (
+            annotations_json,
+            layer["digest"],
+            layer["mediaType"],
+            layer_order,
+            layer["size"],
+            urls_json,
+            manifest_config["digest"],
+            manifest_config["mediaType"],
+            manifest_config["size"],
+            manifest.get("mediaType", ""),
+            manifest["schemaVersion"],
+        )
+
+
 async def insert_manifest(
     conn: asyncpg.connection.Connection, manifest: OCIManifest
 ) -> Tuple[Optional[str], Optional[Exception]]:
     try:
-        layer_order = 0
-        manifest_config = manifest["config"]
-        for layer in manifest["layers"]:
-            annotations_json, urls_json = create_json(manifest, layer)
-
-            digest = layer["digest"]
+        for record in manifest_layer_records(manifest):
             ts = await conn.fetchval(
                 """INSERT INTO manifest_layers(
             annotations,
@@ -288,32 +329,18 @@ async def insert_manifest(
             ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
             RETURNING ts
             """,
-                annotations_json,
-                digest,
-                layer["mediaType"],
-                layer_order,
-                layer["size"],
-                urls_json,
-                manifest_config["digest"],
-                manifest_config["mediaType"],
-                manifest_config["size"],
-                manifest.get("mediaType", ""),
-                manifest["schemaVersion"],
+                *record,
             )
 
-            log.info(f"Inserted manifest layer digest {digest} at timestamp {ts}")
-            layer_order += 1
+            log.info(f"Inserted manifest layer digest {record[1]} at timestamp {ts}")
+        # Delivered to the other instances once the transaction commits
+        await publish(conn, MANIFEST, manifest["config"]["digest"])
         return (str(ts), None)
     except Exception as e:
         return (None, e)
 
 
-async def select_manifest(
-    conn: asyncpg.connection.Connection, manifest_id: str
-) -> Tuple[Optional[OCIManifest], Optional[Exception]]:
-    try:
-        stmt = await conn.prepare(
-            """SELECT
+MANIFEST_LAYER_COLUMNS = """
         annotations,
         digest,
         media_type,
@@ -324,9 +351,18 @@ async def select_manifest(
         manifest_config_media_type,
         manifest_config_size,
         manifest_media_type,
-        manifest_schema_version
+        manifest_schema_version"""
+
+
+async def select_manifest(
+    conn: asyncpg.connection.Connection, manifest_id: str
+) -> Tuple[Optional[OCIManifest], Optional[Exception]]:
+    try:
+        stmt = await conn.prepare(
+            f"""SELECT {MANIFEST_LAYER_COLUMNS}
         FROM manifest_layers
         WHERE manifest_config_digest = $1
+        ORDER BY layer_order
         """
         )
         layers = await stmt.fetch(manifest_id)
@@ -336,24 +372,11 @@ async def select_manifest(
             urls = json.loads(layer["urls"])
             annotations = json.loads(layer["annotations"])
             if manifest is None:
-                layer_list: List[OCIContentDescriptor] = [
+                manifest = convert_manifest(layer, urls, annotations)
+            else:
+                cast(List[OCIContentDescriptor], manifest["layers"]).append(
                     convert_layer(layer, urls, annotations)
-                ]
-                manifest = OCIManifest(
-                    schemaVersion=layer["manifest_schema_version"],
-                    mediaType=layer["manifest_media_type"],
-                    config=OCIContentDescriptor(
-                        mediaType=layer["manifest_config_media_type"],
-                        digest=layer["manifest_config_digest"],
-                        size=layer["manifest_config_size"],
-                        urls=urls.get("manifest_config"),
-                        annotations=annotations.get("manifest_config"),
-                    ),
-                    layers=layer_list,
-                    annotations=annotations.get("manifest"),
                 )
-            else:
-                layer_list.append(convert_layer(layer, urls, annotations))
 
         logging.info(f"Selected manifest {manifest}")
         return (manifest, None)
@@ -362,6 +385,69 @@ async def select_manifest(
         return (None, e)
 
 
+async def select_manifests(
+    conn: asyncpg.connection.Connection,
+    since: datetime,
+    until: datetime,
+    prefetch: int = 100,
+) -> AsyncGenerator[Tuple[datetime, OCIManifest], None]:
+    """Yield the manifests pushed in [since, until), with when they were pushed,
+    one at a time.
+    Rows are read through a server side cursor so only `prefetch` rows are held
+    in memory, the ts range lets Postgres prune the partitions it scans.
+    Layers of one manifest share a ts (NOW() is the transaction start) so
+    ordering by manifest config digest then layer order keeps them adjacent."""
+    manifest: Optional[OCIManifest] = None
+    ts: Optional[datetime] = None
+    async with conn.transaction():
+        async for layer in conn.cursor(
+            f"""SELECT {MANIFEST_LAYER_COLUMNS}, ts
+        FROM manifest_layers
+        WHERE ts >= $1 AND ts < $2
+        ORDER BY manifest_config_digest, layer_order
+        """,
+            since,
+            until,
+            prefetch=prefetch,
+        ):
+            urls = json.loads(layer["urls"])
+            annotations = json.loads(layer["annotations"])
+            if (
+                manifest is not None
+                and manifest["config"]["digest"] == layer["manifest_config_digest"]
+            ):
+                cast(List[OCIContentDescriptor], manifest["layers"]).append(
+                    convert_layer(layer, urls, annotations)
+                )
+                continue
+            if manifest is not None and ts is not None:
+                yield (ts, manifest)
+            manifest = convert_manifest(layer, urls, annotations)
+            ts = layer["ts"]
+    if manifest is not None and ts is not None:
+        yield (ts, manifest)
+
+
+def convert_manifest(
+    layer: Mapping, urls: Mapping, annotations: Mapping
+) -> OCIManifest:
+    """Build a manifest holding only the given (first) layer"""
+    layer_list: List[OCIContentDescriptor] = [convert_layer(layer, urls, annotations)]
+    return OCIManifest(
+        schemaVersion=layer["manifest_schema_version"],
+        mediaType=layer["manifest_media_type"],
+        config=OCIContentDescriptor(
+            mediaType=layer["manifest_config_media_type"],
+            digest=layer["manifest_config_digest"],
+            size=layer["manifest_config_size"],
+            urls=urls.get("manifest_config"),
+            annotations=annotations.get("manifest_config"),
+        ),
+        layers=layer_list,
+        annotations=annotations.get("manifest"),
+    )
+
+
 def convert_layer(
     layer: Mapping, urls: Mapping, annotations: Mapping
 ) -> OCIContentDescriptor:
@@ -389,9 +475,47 @@ async def conn_pool(app):
     """Create a connection pool, calling this method assumes the following environment variables are set
       PGPASSWORD, PGUSER, PGHOST and PGDATABASE
     see https://www.postgresql.org/docs/current/libpq-envars.html for details e.g.
+    When REPLICA_PGHOST is set a second pool is created for reads, see replica.py
     """
     app.logger.info("Initializing Postgres connection pool")
     app["conn_pool"] = await asyncpg.create_pool(command_timeout=60)
+    app["read_router"] = ReadRouter(app["conn_pool"])
+    if settings.REPLICA_PGHOST:
+        app.logger.info(
+            f"Initializing Postgres read replica pool for {settings.REPLICA_PGHOST}"
+        )
+        # min_size=0 so a replica which is down does not stop the service starting
+        app["read_router"].replica = await asyncpg.create_pool(
+            host=settings.REPLICA_PGHOST,
+            port=settings.REPLICA_PGPORT,
+            user=settings.REPLICA_PGUSER,
+            password=settings.REPLICA_PGPASSWORD,
+            database=settings.REPLICA_PGDATABASE,
+            min_size=0,
+            command_timeout=60,
+        )
+        monitor = asyncio.create_task(app["read_router"].monitor())
+
+    app["manifest_cache"] = TTLCache(
+        settings.MANIFEST_CACHE_TTL_SECONDS, settings.MANIFEST_CACHE_SIZE
+    )
+    app["ready_cache"] = TTLCache(settings.READY_CACHE_SECONDS, 1)
+    app["invalidation_listener"] = listener = InvalidationListener()
+    listener.on(MANIFEST, app["manifest_cache"].invalidate)
+    listener.on_reset(app["manifest_cache"].clear)
+    listener.on_reset(app["ready_cache"].clear)
+    if blob_cache := app.get(BLOB_CACHE):
+        listener.on(
+            LAYER,
+            lambda name: blob_cache.invalidate(os.path.join(settings.LAYERS_DIR, name)),
+        )
+        listener.on_reset(blob_cache.clear)
+    listening = asyncio.create_task(listener.run())
     yield
+    listening.cancel()
+    if app["read_router"].replica:
+        monitor.cancel()
+        app.logger.info("Closing Postgres read replica pool")
+        await app["read_router"].replica.close()
     app.logger.info("Closing Postgres connection pool")
     await app["conn_pool"].close()
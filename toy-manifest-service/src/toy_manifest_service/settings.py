@@ -1,3 +1,43 @@
 import os
 
 PORT = int(os.environ.get("PORT", "4000"))
+
+# Rows fetched per round trip when streaming GET /manifests
+MANIFEST_CURSOR_PREFETCH = int(os.environ.get("MANIFEST_CURSOR_PREFETCH", "500"))
+# Window used by GET /manifests when since is not given
+MANIFEST_LIST_DEFAULT_DAYS = int(os.environ.get("MANIFEST_LIST_DEFAULT_DAYS", "7"))
+
+# Per request phase timings, also toggled live through POST /admin/timing
+TIMING_ENABLED = os.environ.get("TIMING_ENABLED", "false").lower() == "true"
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+# Bearer token for the /admin endpoints, which are disabled when unset
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# Optional read replica, reads use the primary when REPLICA_PGHOST is unset.
+# The other connection settings default to the primary's PG* variables
+REPLICA_PGHOST = os.environ.get("REPLICA_PGHOST", "")
+REPLICA_PGPORT = os.environ.get("REPLICA_PGPORT")
+REPLICA_PGUSER = os.environ.get("REPLICA_PGUSER")
+REPLICA_PGPASSWORD = os.environ.get("REPLICA_PGPASSWORD")
+REPLICA_PGDATABASE = os.environ.get("REPLICA_PGDATABASE")
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", "5"))
+REPLICA_CHECK_INTERVAL_SECONDS = float(
+    os.environ.get("REPLICA_CHECK_INTERVAL_SECONDS", "1")
+)
+
+# Where uploaded layer blobs are stored and served from
+LAYERS_DIR = os.environ.get("LAYERS_DIR", "/layers")
+# Hot layer cache, blobs up to BLOB_CACHE_SMALL_BLOB_BYTES are held in memory
+# and larger ones are mmap'd, each tier under its own byte budget
+BLOB_CACHE_ENABLED = os.environ.get("BLOB_CACHE_ENABLED", "true").lower() == "true"
+BLOB_CACHE_MEMORY_BYTES = int(os.environ.get("BLOB_CACHE_MEMORY_BYTES", str(256 << 20)))
+BLOB_CACHE_MMAP_BYTES = int(os.environ.get("BLOB_CACHE_MMAP_BYTES", str(4 << 30)))
+BLOB_CACHE_SMALL_BLOB_BYTES = int(
+    os.environ.get("BLOB_CACHE_SMALL_BLOB_BYTES", str(4 << 20))
+)
+
+# Per process caches, invalidated across instances through LISTEN/NOTIFY
+MANIFEST_CACHE_TTL_SECONDS = float(os.environ.get("MANIFEST_CACHE_TTL_SECONDS", "3600"))
+MANIFEST_CACHE_SIZE = int(os.environ.get("MANIFEST_CACHE_SIZE", "10000"))
+READY_CACHE_SECONDS = float(os.environ.get("READY_CACHE_SECONDS", "5"))
+LISTENER_PING_SECONDS = float(os.environ.get("LISTENER_PING_SECONDS", "10"))
@@ -1,16 +1,46 @@
+import asyncio
 import hashlib
+import hmac
+import json
 import logging
 import os
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
 
 import aiofiles
+import asyncpg
 from aiohttp import hdrs, web
 
-from .schema import build_manifest, insert_manifest, schema_ready, select_manifest
+from . import settings
+from .blobcache import BLOB_CACHE, DISK, MMAP
+from .listener import LAYER, publish
+from .profiling import (
+    TIMING_CONFIG,
+    acquire,
+    collapsed,
+    request_timings,
+    sample_stacks,
+)
+from .replica import LSN_COOKIE, current_lsn, parse_lsn
+from .schema import (
+    build_manifest,
+    insert_manifest,
+    schema_ready,
+    select_manifest,
+    select_manifests,
+)
 
 log = logging.getLogger(__name__)
 
 routes = web.RouteTableDef()
 
+LAYER_MEDIA_TYPE = "application/vnd.oci.image.layer.v1.tar+gzip"
+# Mapped and large cached blobs are written in chunks of this size, draining
+# between them, so a slow client never has the whole blob copied into the
+# transport's buffer
+LAYER_CHUNK_SIZE = 1 << 20
+
 
 @routes.route("OPTIONS", "/manifest")
 async def publish_options(request: web.Request) -> web.Response:
@@ -34,18 +64,20 @@ async def post_manifest(request: web.Request) -> web.Response:
             {"message": f"Expecting {expected_type} not {content_type}"}, status=400
         )
 
+    timings = request_timings(request)
     reader = await request.multipart()
     pool = request.app["conn_pool"]
     manifest_digest = ""
     timestamp = ""
-    async with pool.acquire() as conn:
+    async with acquire(pool, timings) as conn:
         async with conn.transaction():
-            while part := await reader.next():
+            while part := await timings.timed("parse", reader.next()):
                 content_type = part.headers[hdrs.CONTENT_TYPE]
 
                 if content_type == "application/json":
-                    manifest_json = await part.json()
-                    (manifest, error) = build_manifest(manifest_json)
+                    with timings.phase("parse"):
+                        manifest_json = await part.json()
+                        (manifest, error) = build_manifest(manifest_json)
                     if error:
                         return web.json_response(
                             {
@@ -59,7 +91,9 @@ async def post_manifest(request: web.Request) -> web.Response:
                     if manifest:
                         log.info(f"Got manifest {manifest}")
                         manifest_digest = manifest["config"]["digest"]
-                        (timestamp, error) = await insert_manifest(conn, manifest)
+                        (timestamp, error) = await timings.timed(
+                            "query", insert_manifest(conn, manifest)
+                        )
                         if error:
                             return web.json_response(
                                 {
@@ -70,32 +104,53 @@ async def post_manifest(request: web.Request) -> web.Response:
                                 status=400,
                             )
 
-                elif content_type == "application/vnd.oci.image.layer.v1.tar+gzip":
+                elif content_type == LAYER_MEDIA_TYPE:
                     filename = part.filename
+                    path = layer_path(filename)
+                    if path is None:
+                        return web.json_response(
+                            {"message": f"Invalid layer filename {filename}"},
+                            status=400,
+                        )
 
                     log.info(
                         f"Uploading layer type {content_type} filename {filename} field name {part.name}"
                     )
                     size = 0
-                    async with aiofiles.open(
-                        os.path.join("/layers", filename), mode="wb"
-                    ) as f:
-                        while chunk := await part.read_chunk(1048576):
+                    async with aiofiles.open(f"{path}.part", mode="wb") as f:
+                        while chunk := await timings.timed(
+                            "parse", part.read_chunk(1048576)
+                        ):
                             size += len(chunk)
-                            await f.write(chunk)
+                            await timings.timed("write", f.write(chunk))
+                    layer_written(request, path)
+                    await publish(conn, LAYER, os.path.basename(path))
                     log.info(f"Wrote {size} bytes to file {filename}")
                 else:
                     log.warn(
                         f"Unhandled content_type {content_type} for {part.filename}"
                     )
+        lsn = None
+        if request.app["read_router"].replica:
+            lsn = await timings.timed("query", current_lsn(conn))
 
-    return web.json_response(
+    response = web.json_response(
         {
             "message": "Manifest successfully posted",
             "manifest_digest": manifest_digest,
             "timestamp": timestamp,
         }
     )
+    if lsn:
+        # Reads by this client avoid the replica until it has replayed this write
+        response.set_cookie(LSN_COOKIE, lsn, max_age=60, httponly=True)
+    return response
+
+
+def read_pool(request: web.Request) -> asyncpg.pool.Pool:
+    """The replica pool when it is healthy and has the client's last write"""
+    min_lsn = parse_lsn(request.cookies.get(LSN_COOKIE))
+    return request.app["read_router"].pool(min_lsn)
 
 
 @routes.get("/manifest/{manifest_id}")
@@ -103,10 +158,30 @@ async def get_manifest(request: web.Request) -> web.Response:
     id = request.match_info["manifest_id"]
     log.info(f"Getting manifest for {id}")
 
-    pool = request.app["conn_pool"]
-    async with pool.acquire() as conn:
-        (manifest, error) = await select_manifest(conn, id)
+    cache = request.app.get("manifest_cache")
+    if cache and (manifest := cache.get(id)):
+        return web.json_response({"manifest": manifest})
+
+    timings = request_timings(request)
+    router = request.app["read_router"]
+    pool = read_pool(request)
+    # Recorded before the query, the replica has replayed at least this far
+    invalidations = cache.invalidations if cache else 0
+    replay_lsn = router.replay_lsn
+    async with acquire(pool, timings) as conn:
+        (manifest, error) = await timings.timed("query", select_manifest(conn, id))
         if manifest:
+            # Only found manifests are cached so a client never misses its own
+            # write, and only if they cannot be older than an invalidation
+            if (
+                cache
+                and cache.invalidations == invalidations
+                and (
+                    pool is not router.replica
+                    or request.app["invalidation_listener"].replica_current(replay_lsn)
+                )
+            ):
+                cache.put(id, manifest)
             return web.json_response({"manifest": manifest})
         if error:
             return web.json_response(
@@ -122,16 +197,144 @@ async def get_manifest(request: web.Request) -> web.Response:
         )
 
 
+def parse_timestamp(value: Optional[str], default: datetime) -> datetime:
+    """Parse an ISO 8601 query parameter, naive timestamps are taken as UTC"""
+    if not value:
+        return default
+    # fromisoformat only accepts a Z suffix from Python 3.11
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    ts = datetime.fromisoformat(value)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts
+
+
+@routes.get("/manifests")
+async def list_manifests(request: web.Request) -> web.StreamResponse:
+    """Stream the manifests pushed between since and until as newline delimited JSON"""
+    try:
+        until = parse_timestamp(request.query.get("until"), datetime.now(timezone.utc))
+        since = parse_timestamp(
+            request.query.get("since"),
+            until - timedelta(days=settings.MANIFEST_LIST_DEFAULT_DAYS),
+        )
+    except ValueError as e:
+        return web.json_response(
+            {"message": "since and until must be ISO 8601 timestamps", "error": str(e)},
+            status=400,
+        )
+    if since >= until:
+        return web.json_response(
+            {"message": f"since {since} must be before until {until}"}, status=400
+        )
+
+    log.info(f"Listing manifests from {since} until {until}")
+    response = web.StreamResponse(headers={hdrs.CONTENT_TYPE: "application/x-ndjson"})
+    pool = read_pool(request)
+    count = 0
+    async with pool.acquire() as conn:
+        manifests = select_manifests(
+            conn, since, until, prefetch=settings.MANIFEST_CURSOR_PREFETCH
+        )
+        try:
+            async for (_, manifest) in manifests:
+                if not response.prepared:
+                    await response.prepare(request)
+                # write waits for the transport to drain so a slow client
+                # holds back the cursor rather than filling memory
+                await response.write(json.dumps(manifest).encode() + b"\n")
+                count += 1
+        finally:
+            # A failed write leaves the generator suspended in its transaction,
+            # it must be closed before the connection goes back to the pool
+            await manifests.aclose()
+    if not response.prepared:
+        await response.prepare(request)
+    await response.write_eof()
+    log.info(f"Listed {count} manifests from {since} until {until}")
+    return response
+
+
+def layer_path(filename: Optional[str]) -> Optional[str]:
+    """Path of a layer blob, None for names which would escape LAYERS_DIR"""
+    if not filename or filename != os.path.basename(filename) or filename[0] == ".":
+        return None
+    return os.path.join(settings.LAYERS_DIR, filename)
+
+
+def layer_written(request: web.Request, path: str):
+    """Move a fully written layer into place. Renaming rather than writing in
+    place means blobs which are mmap'd or being sent are never truncated."""
+    os.replace(f"{path}.part", path)
+    if cache := request.app.get(BLOB_CACHE):
+        cache.invalidate(path)
+
+
+def requested_bytes(request: web.Request, size: int) -> int:
+    """How many bytes of a size byte blob the request's Range asks for"""
+    try:
+        http_range = request.http_range
+    except ValueError:
+        return 0
+    if http_range.start is None and http_range.stop is None:
+        return size
+    (start, stop, _) = http_range.indices(size)
+    return max(0, stop - start)
+
+
 @routes.get("/layer/{layer_id}")
-async def get_layer(request: web.Request) -> web.Response:
+async def get_layer(request: web.Request) -> web.StreamResponse:
     layer_id = request.match_info["layer_id"]
+    not_found = web.json_response(
+        {"message": f"Layer for {layer_id} not found"}, status=404
+    )
+    path = layer_path(layer_id)
+    if path is None:
+        return not_found
 
-    if False:
-        response = web.json_response({"layer": layer_id})
-        response.headers["Content-Type"] = "application/vnd.oci.image.layer.v1.tar+gzip"
-        return response
+    cache = request.app.get(BLOB_CACHE)
+    try:
+        blob = await cache.get(path) if cache else None
+        if blob is None and not os.path.isfile(path):
+            return not_found
+    except FileNotFoundError:
+        return not_found
 
-    return web.json_response({"message": f"Layer for {layer_id} not found"}, status=404)
+    headers = {hdrs.CONTENT_TYPE: LAYER_MEDIA_TYPE, hdrs.ACCEPT_RANGES: "bytes"}
+    if blob is None:
+        # Cold blob, FileResponse handles Range and uses sendfile once aiohttp
+        # prepares it, so it must be returned unprepared
+        if cache:
+            cache.served(DISK, requested_bytes(request, os.stat(path).st_size))
+        return web.FileResponse(path, headers=headers)
+
+    (view, tier) = blob
+    size = len(view)
+    try:
+        http_range = request.http_range
+    except ValueError:
+        return web.Response(status=416, headers={hdrs.CONTENT_RANGE: f"bytes */{size}"})
+    status = 200
+    if http_range.start is not None or http_range.stop is not None:
+        (start, stop, _) = http_range.indices(size)
+        if start >= stop:
+            return web.Response(
+                status=416, headers={hdrs.CONTENT_RANGE: f"bytes */{size}"}
+            )
+        view = view[start:stop]
+        status = 206
+        headers[hdrs.CONTENT_RANGE] = f"bytes {start}-{stop - 1}/{size}"
+    cache.served(tier, len(view))
+    if tier != MMAP and len(view) <= LAYER_CHUNK_SIZE:
+        return web.Response(body=view, status=status, headers=headers)
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_length = len(view)
+    await response.prepare(request)
+    for offset in range(0, len(view), LAYER_CHUNK_SIZE):
+        await response.write(view[offset : offset + LAYER_CHUNK_SIZE])
+    await response.write_eof()
+    return response
 
 
 @routes.post("/layer/{layer_id}")
@@ -149,16 +352,26 @@ async def post_layer(request: web.Request) -> web.Response:
             f"Uploading file length {content_len} type {content_type} filename {filename} field name {field.name}"
         )
         # You cannot rely on Content-Length if transfer is chunked.
+        timings = request_timings(request)
         size = 0
         layer_digest = hashlib.sha256()
-        async with aiofiles.open(os.path.join("/layers", filename), mode="wb") as f:
+        path = layer_path(filename)
+        if path is None:
+            return web.json_response(
+                {"message": f"Invalid layer filename {filename}"}, status=400
+            )
+        async with aiofiles.open(f"{path}.part", mode="wb") as f:
             while True:
-                chunk = await field.read_chunk(1048576)
+                chunk = await timings.timed("parse", field.read_chunk(1048576))
                 if not chunk:
                     break
                 size += len(chunk)
-                layer_digest.update(chunk)
-                await f.write(chunk)
+                with timings.phase("hash"):
+                    layer_digest.update(chunk)
+                await timings.timed("write", f.write(chunk))
+        layer_written(request, path)
+        if "conn_pool" in request.app:
+            await publish(request.app["conn_pool"], LAYER, os.path.basename(path))
 
     sha256_digest = f"sha256:{layer_digest.hexdigest()}"
     return web.json_response({"upload_digest": sha256_digest, "layer_id": layer_id})
@@ -174,8 +387,91 @@ async def livez(request: web.Request) -> web.Response:
 # See https://kubernetes.io/docs/reference/using-api/health-checks/ for details
 @routes.get("/readyz")
 async def readyz(request: web.Request) -> web.Response:
-    pool = request.app["conn_pool"]
+    ready_cache = request.app.get("ready_cache")
+    if ready_cache and ready_cache.get("schema"):
+        return web.Response()
+    pool = read_pool(request)
     if is_ready := await schema_ready(pool):
         log.debug(f"Toy manifest service is ready {is_ready}")
+        if ready_cache:
+            ready_cache.put("schema", True)
         return web.Response()
     return web.Response(status=503)
+
+
+def is_admin(request: web.Request) -> bool:
+    """Admin endpoints require ADMIN_TOKEN as a bearer token, none when it is unset"""
+    if not settings.ADMIN_TOKEN:
+        return False
+    expected = f"Bearer {settings.ADMIN_TOKEN}"
+    return hmac.compare_digest(request.headers.get(hdrs.AUTHORIZATION, ""), expected)
+
+
+@routes.post("/admin/timing")
+async def admin_timing(request: web.Request) -> web.Response:
+    """Toggle per request phase timings and the slow request threshold"""
+    if not is_admin(request):
+        return web.json_response({"message": "Forbidden"}, status=403)
+    config = request.app[TIMING_CONFIG]
+    if request.can_read_body:
+        body = await request.json()
+        config.enabled = bool(body.get("enabled", config.enabled))
+        config.slow_request_ms = float(
+            body.get("slow_request_ms", config.slow_request_ms)
+        )
+        log.info(
+            f"Request timing enabled {config.enabled} slow request threshold {config.slow_request_ms}ms"
+        )
+    return web.json_response(
+        {"enabled": config.enabled, "slow_request_ms": config.slow_request_ms}
+    )
+
+
+@routes.post("/admin/profile")
+async def admin_profile(request: web.Request) -> web.Response:
+    """Sample the event loop thread for the given seconds and return collapsed stacks"""
+    if not is_admin(request):
+        return web.json_response({"message": "Forbidden"}, status=403)
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+        interval_ms = float(request.query.get("interval_ms", "10"))
+    except ValueError as e:
+        return web.json_response(
+            {"message": "seconds and interval_ms must be numbers", "error": str(e)},
+            status=400,
+        )
+    if not 0 < seconds <= 300 or not 1 <= interval_ms <= 1000:
+        return web.json_response(
+            {"message": "seconds must be in (0, 300] and interval_ms in [1, 1000]"},
+            status=400,
+        )
+
+    config = request.app[TIMING_CONFIG]
+    if config.profiling:
+        return web.json_response({"message": "Already profiling"}, status=409)
+    config.profiling = True
+    try:
+        log.info(f"Profiling for {seconds}s every {interval_ms}ms")
+        # The sampler runs on a worker thread while this (event loop) thread
+        # carries on serving requests, which is what gets sampled
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            None,
+            sample_stacks,
+            threading.get_ident(),
+            seconds,
+            interval_ms / 1000,
+        )
+    finally:
+        config.profiling = False
+    return web.Response(text=collapsed(stacks))
+
+
+@routes.get("/admin/blob-cache")
+async def admin_blob_cache(request: web.Request) -> web.Response:
+    """Hit ratio, requests and bytes served per tier of the hot layer cache"""
+    if not is_admin(request):
+        return web.json_response({"message": "Forbidden"}, status=403)
+    cache = request.app.get(BLOB_CACHE)
+    if cache is None:
+        return web.json_response({"message": "Blob cache disabled"}, status=404)
+    return web.json_response(cache.stats())
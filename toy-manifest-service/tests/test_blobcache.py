@@ -0,0 +1,156 @@
+import asyncio
+import threading
+
+import pytest
+from aiohttp import web
+
+from toy_manifest_service import blobcache, settings, views
+from toy_manifest_service.blobcache import (
+    BLOB_CACHE,
+    DISK,
+    MEMORY,
+    MMAP,
+    BlobCache,
+    FrequencySketch,
+)
+
+
+@pytest.fixture
+def layers_cli(loop, aiohttp_client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "LAYERS_DIR", str(tmp_path))
+    monkeypatch.setattr(views, "LAYER_CHUNK_SIZE", 100)
+    (tmp_path / "small.tar.gz").write_bytes(b"0123456789")
+    (tmp_path / "large.tar.gz").write_bytes(bytes(range(256)) * 16)
+    app = web.Application()
+    app.add_routes(views.routes)
+    app[BLOB_CACHE] = BlobCache(
+        memory_budget=1024, mmap_budget=1 << 20, small_blob_max=100
+    )
+    return loop.run_until_complete(aiohttp_client(app))
+
+
+def test_frequency_sketch_ages():
+    sketch = FrequencySketch(width=64)
+    for _ in range(100):
+        sketch.increment("hot")
+    assert sketch.estimate("hot") >= 100
+    # Each counter sees about sample_size / width cold keys, far fewer than
+    # the 50 the halving takes away from hot
+    for i in range(sketch.sample_size):
+        sketch.increment(f"cold-{i}")
+    assert sketch.estimate("hot") < 100
+
+
+async def test_admission_and_eviction(tmp_path):
+    paths = []
+    for name in ["a", "b", "c"]:
+        path = tmp_path / name
+        path.write_bytes(name.encode() * 40)
+        paths.append(str(path))
+    (a, b, c) = paths
+    cache = BlobCache(memory_budget=80, mmap_budget=0, small_blob_max=100)
+
+    # One-off reads are not admitted
+    assert await cache.get(a) is None
+    (view, tier) = await cache.get(a)
+    assert (bytes(view), tier) == (b"a" * 40, MEMORY)
+
+    for _ in range(3):
+        await cache.get(b)
+    assert set(cache.blobs) == {a, b}
+
+    # c is no hotter than a so it cannot evict it
+    await cache.get(c)
+    assert await cache.get(c) is None
+    for _ in range(3):
+        await cache.get(c)
+    assert set(cache.blobs) == {b, c}
+    assert cache.used[MEMORY] == 80
+
+    cache.invalidate(b)
+    assert cache.used[MEMORY] == 40
+    assert cache.stats()["requests"][DISK] > 0
+
+
+async def test_invalidate_during_load(tmp_path, monkeypatch):
+    path = tmp_path / "blob"
+    path.write_bytes(b"old" * 10)
+    cache = BlobCache(memory_budget=1024, small_blob_max=100, min_admit_frequency=1)
+
+    # Each load reads the file, then waits until the test lets it finish
+    read = [threading.Event(), threading.Event()]
+    finish = [threading.Event(), threading.Event()]
+    loads = iter(range(2))
+
+    def slow_read_blob(blob_path):
+        load = next(loads)
+        with open(blob_path, "rb") as f:
+            data = f.read()
+        read[load].set()
+        finish[load].wait(5)
+        return data
+
+    monkeypatch.setattr(blobcache, "read_blob", slow_read_blob)
+    loop = asyncio.get_running_loop()
+    first = asyncio.ensure_future(cache.get(str(path)))
+    await loop.run_in_executor(None, read[0].wait, 5)
+
+    # The layer is replaced while the first load holds the old bytes
+    path.write_bytes(b"new" * 10)
+    cache.invalidate(str(path))
+    second = asyncio.ensure_future(cache.get(str(path)))
+    await loop.run_in_executor(None, read[1].wait, 5)
+
+    finish[0].set()
+    (view, _) = await first
+    assert bytes(view) == b"old" * 10
+    assert str(path) not in cache.blobs
+    finish[1].set()
+    (view, _) = await second
+    assert bytes(view) == b"new" * 10
+    assert bytes(cache.blobs[str(path)].data) == b"new" * 10
+    assert cache.used[MEMORY] == 30
+
+
+async def test_get_layer_tiers_and_ranges(layers_cli):
+    for _ in range(3):
+        resp = await layers_cli.get("/layer/small.tar.gz")
+        assert resp.status == 200
+        assert resp.content_type == views.LAYER_MEDIA_TYPE
+        assert await resp.read() == b"0123456789"
+
+    resp = await layers_cli.get("/layer/small.tar.gz", headers={"Range": "bytes=2-4"})
+    assert resp.status == 206
+    assert resp.headers["Content-Range"] == "bytes 2-4/10"
+    assert await resp.read() == b"234"
+
+    resp = await layers_cli.get("/layer/small.tar.gz", headers={"Range": "bytes=-3"})
+    assert await resp.read() == b"789"
+
+    resp = await layers_cli.get("/layer/small.tar.gz", headers={"Range": "bytes=20-"})
+    assert resp.status == 416
+
+    large = bytes(range(256)) * 16
+    for _ in range(2):
+        resp = await layers_cli.get(
+            "/layer/large.tar.gz", headers={"Range": "bytes=256-511"}
+        )
+        assert resp.status == 206
+        assert await resp.read() == large[256:512]
+    # Written in chunks
+    resp = await layers_cli.get("/layer/large.tar.gz")
+    assert resp.headers["Content-Length"] == str(len(large))
+    assert await resp.read() == large
+
+    stats = layers_cli.server.app[BLOB_CACHE].stats()
+    assert stats["requests"][MEMORY] > 0
+    assert stats["requests"][MMAP] > 0
+    assert stats["bytes_served"][DISK] == 10 + 256
+    assert stats["bytes_served"][MMAP] == 256 + len(large)
+
+
+async def test_get_layer_not_found(layers_cli):
+    resp = await layers_cli.get("/layer/missing.tar.gz")
+    assert resp.status == 404
+    resp = await layers_cli.get("/layer/..")
+    assert resp.status == 404
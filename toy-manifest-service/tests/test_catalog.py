@@ -0,0 +1,125 @@
+import asyncio
+import io
+import json
+from datetime import datetime, timezone
+
+import asyncpg
+import pytest
+from test_views import wait_for_db
+
+from toy_manifest_service import catalog
+from toy_manifest_service.schema import OCIContentDescriptor, OCIManifest
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / "import.ckpt")
+    checkpoint = catalog.Checkpoint(path)
+    checkpoint.commit(10, 20)
+    assert checkpoint.line == 0
+    checkpoint.commit(0, 10)
+    checkpoint.commit(30, 40)
+    assert checkpoint.line == 20
+
+    resumed = catalog.Checkpoint(path)
+    assert resumed.line == 20
+    assert resumed.skip(19)
+    assert not resumed.skip(20)
+    assert resumed.skip(35)
+    assert not resumed.skip(40)
+
+
+def test_pop_pushed():
+    line = {"schemaVersion": 2, "ts": "2024-01-01T12:00:00+00:00"}
+    assert catalog.pop_pushed(line) == datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+    assert line == {"schemaVersion": 2}
+    assert catalog.pop_pushed(line) is None
+    assert catalog.pop_pushed([]) is None
+    with pytest.raises(ValueError):
+        catalog.pop_pushed({"ts": "yesterday"})
+
+
+async def test_import_failure_cancels_batches(monkeypatch):
+    started = []
+    cancelled = []
+
+    async def copy_batch(pool, records, start, end, checkpoint):
+        started.append(start)
+        if start == 0:
+            raise ValueError("COPY failed")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(start)
+            raise
+
+    monkeypatch.setattr(catalog, "copy_batch", copy_batch)
+    manifest = {
+        "schemaVersion": 2,
+        "config": {"mediaType": "application/json", "size": 1, "digest": "sha256:a"},
+        "layers": [{"mediaType": "application/gzip", "size": 1, "digest": "sha256:b"}],
+    }
+    lines = io.StringIO((json.dumps(manifest) + "\n") * 10)
+    with pytest.raises(ValueError):
+        await catalog.import_manifests(None, lines, batch_size=1, concurrency=3)
+    # Every batch in flight when the failure was seen is cancelled and awaited
+    assert len(started) > 1
+    assert sorted(cancelled) == sorted(started[1:])
+
+
+async def test_import_export_roundtrip(tmp_path):
+    await wait_for_db()
+    manifest: OCIManifest = {
+        "schemaVersion": 2,
+        "config": OCIContentDescriptor(
+            mediaType="application/vnd.oci.image.config.v1+json",
+            size=4242,
+            digest="sha256:0004b2c507a0944348e0303114d8d93aaaa081732b86451d9bce1f432a537000",
+            annotations={},
+            urls=[],
+        ),
+        "layers": [
+            OCIContentDescriptor(
+                mediaType="application/vnd.oci.image.layer.v1.tar+gzip",
+                size=4343,
+                digest="sha256:1004876dcfb05cb167a5c24953eba58c4ac89b1adf57f28f2f9d09af107ee123",
+                annotations={},
+                urls=[],
+            ),
+        ],
+        "annotations": {},
+        "mediaType": "",
+    }
+    lines = io.StringIO(json.dumps(manifest) + "\nnot json\n" + json.dumps({}) + "\n")
+    checkpoint = catalog.Checkpoint(str(tmp_path / "import.ckpt"))
+
+    async with asyncpg.create_pool() as pool:
+        (imported, rejected) = await catalog.import_manifests(
+            pool, lines, batch_size=1, checkpoint=checkpoint
+        )
+        assert (imported, rejected) == (1, 2)
+
+        # A resumed import skips the committed lines
+        lines.seek(0)
+        (imported, rejected) = await catalog.import_manifests(
+            pool, lines, checkpoint=catalog.Checkpoint(checkpoint.path)
+        )
+        assert imported == 0
+
+        # As if the checkpoint was lost in a crash after the batch committed
+        lines.seek(0)
+        (imported, rejected) = await catalog.import_manifests(pool, lines)
+        assert (imported, rejected) == (1, 2)
+
+        out = io.StringIO()
+        async with pool.acquire() as conn:
+            await catalog.export_manifests(
+                conn,
+                out,
+                datetime(1970, 1, 1, tzinfo=timezone.utc),
+                datetime(9999, 1, 1, tzinfo=timezone.utc),
+            )
+    exported = [json.loads(line) for line in out.getvalue().splitlines()]
+    # Each line carries when the manifest was pushed
+    pushed = [datetime.fromisoformat(m.pop("ts")) for m in exported]
+    assert all(ts.tzinfo for ts in pushed)
+    assert manifest in exported
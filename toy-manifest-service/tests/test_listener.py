@@ -0,0 +1,98 @@
+import asyncio
+
+import asyncpg
+from test_views import wait_for_db
+
+from toy_manifest_service.cache import TTLCache
+from toy_manifest_service.listener import (
+    CHANNEL,
+    MANIFEST,
+    InvalidationListener,
+    publish,
+)
+from toy_manifest_service.replica import parse_lsn
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=60, max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # b was least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    invalidations = cache.invalidations
+    cache.invalidate("c")
+    assert cache.get("c") is None
+    assert cache.invalidations == invalidations + 1
+
+    expired = TTLCache(ttl=0)
+    expired.put("a", 1)
+    assert expired.get("a") is None
+
+
+class FakeConnection:
+    def __init__(self, lsn):
+        self.lsn = lsn
+        self.read = asyncio.Event()
+        self.reads = 0
+
+    async def fetchval(self, query, timeout=None):
+        self.reads += 1
+        await self.read.wait()
+        return self.lsn
+
+
+async def test_replica_current_after_invalidations():
+    listener = InvalidationListener()
+    listener.on(MANIFEST, lambda key: None)
+    conn = FakeConnection("0/100")
+    listener.conn = conn
+    listener.notified(conn, 1, CHANNEL, f"{MANIFEST}:sha256:abc")
+    await asyncio.sleep(0)
+    # Unknown until the WAL position has been read
+    assert not listener.replica_current(parse_lsn("0/200"))
+
+    # A burst during the read is covered by one more read
+    for i in range(10):
+        listener.notified(conn, 1, CHANNEL, f"{MANIFEST}:sha256:{i}")
+    conn.read.set()
+    for _ in range(10):
+        await asyncio.sleep(0)
+    assert conn.reads == 2
+    assert listener.invalidated_lsn == parse_lsn("0/100")
+    assert listener.replica_current(parse_lsn("0/100"))
+    assert not listener.replica_current(parse_lsn("0/FF"))
+    assert not listener.replica_current(None)
+
+
+async def test_invalidation_across_connections():
+    await wait_for_db()
+    cache = TTLCache(ttl=3600)
+    listener = InvalidationListener()
+    listener.on(MANIFEST, cache.invalidate)
+    listener.on_reset(cache.clear)
+    listening = asyncio.create_task(listener.run())
+    try:
+        await asyncio.wait_for(listener.connected.wait(), 10)
+        cache.put("sha256:abc", {"schemaVersion": 2})
+        cache.put("sha256:def", {"schemaVersion": 2})
+
+        # As if written by another instance
+        async with asyncpg.create_pool() as pool:
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await publish(conn, MANIFEST, "sha256:abc")
+                    await asyncio.sleep(0.2)
+                    # Not delivered until the commit
+                    assert cache.get("sha256:abc")
+
+        for _ in range(50):
+            if cache.get("sha256:abc") is None:
+                break
+            await asyncio.sleep(0.1)
+        assert cache.get("sha256:abc") is None
+        assert cache.get("sha256:def")
+    finally:
+        listening.cancel()
@@ -0,0 +1,77 @@
+import logging
+
+import pytest
+from aiohttp import web
+
+from toy_manifest_service import profiling, settings, views
+
+
+@pytest.fixture
+def admin_cli(loop, aiohttp_client, monkeypatch):
+    monkeypatch.setattr(settings, "ADMIN_TOKEN", "secret")
+    app = web.Application(middlewares=[profiling.timing_middleware])
+    app.add_routes(views.routes)
+    app[profiling.TIMING_CONFIG] = profiling.TimingConfig(enabled=False)
+    return loop.run_until_complete(aiohttp_client(app))
+
+
+async def test_request_timings():
+    timings = profiling.RequestTimings()
+    with timings.phase("parse"):
+        pass
+    assert await timings.timed("query", noop()) == 42
+    assert set(timings.phases) == {"parse", "query"}
+    assert "query=" in timings.breakdown()
+
+    with profiling.NULL_TIMINGS.phase("parse"):
+        pass
+    assert profiling.NULL_TIMINGS.phases == {}
+
+
+async def noop():
+    return 42
+
+
+async def test_admin_requires_token(admin_cli):
+    resp = await admin_cli.post("/admin/timing")
+    assert resp.status == 403
+
+    resp = await admin_cli.post(
+        "/admin/profile", headers={"Authorization": "Bearer wrong"}
+    )
+    assert resp.status == 403
+
+
+async def test_slow_request_logged(admin_cli, caplog):
+    caplog.set_level(logging.INFO)
+    headers = {"Authorization": "Bearer secret"}
+
+    await admin_cli.get("/livez")
+    assert "Slow request" not in caplog.text
+
+    resp = await admin_cli.post(
+        "/admin/timing", json={"enabled": True, "slow_request_ms": 0}, headers=headers
+    )
+    assert resp.status == 200
+    assert await resp.json() == {"enabled": True, "slow_request_ms": 0}
+
+    await admin_cli.get("/livez")
+    assert "Slow request GET /livez" in caplog.text
+
+
+async def test_admin_profile(admin_cli):
+    headers = {"Authorization": "Bearer secret"}
+    resp = await admin_cli.post(
+        "/admin/profile", params={"seconds": "0.2", "interval_ms": "5"}, headers=headers
+    )
+    assert resp.status == 200
+    lines = (await resp.text()).splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert ";" in stack
+    assert int(count) > 0
+
+    resp = await admin_cli.post(
+        "/admin/profile", params={"seconds": "3600"}, headers=headers
+    )
+    assert resp.status == 400
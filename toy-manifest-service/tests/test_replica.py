@@ -0,0 +1,60 @@
+from toy_manifest_service.replica import ReadRouter, parse_lsn
+
+
+class FakeReplica:
+    def __init__(self, row=None, error=None):
+        self.row = row
+        self.error = error
+
+    async def fetchrow(self, query, timeout=None):
+        if self.error:
+            raise self.error
+        return self.row
+
+
+def test_parse_lsn():
+    assert parse_lsn("0/0") == 0
+    assert parse_lsn("16/B374D848") == (0x16 << 32) | 0xB374D848
+    assert parse_lsn("1/0") > parse_lsn("0/FFFFFFFF")
+    assert parse_lsn("") is None
+    assert parse_lsn("garbage") is None
+
+
+async def test_routes_to_healthy_replica():
+    primary = object()
+    replica = FakeReplica({"lag": 0, "replay_lsn": "0/100"})
+    router = ReadRouter(primary, replica, max_lag_seconds=5)
+    assert router.pool() is primary
+
+    await router.check()
+    assert router.healthy
+    assert router.pool() is replica
+    assert router.pool(min_lsn=parse_lsn("0/100")) is replica
+    # Read-your-writes, the replica has not replayed this client's write yet
+    assert router.pool(min_lsn=parse_lsn("0/101")) is primary
+
+
+async def test_falls_back_to_primary():
+    primary = object()
+    replica = FakeReplica({"lag": 30, "replay_lsn": "0/100"})
+    router = ReadRouter(primary, replica, max_lag_seconds=5)
+    await router.check()
+    assert not router.healthy
+    assert router.pool() is primary
+
+    replica.row = {"lag": 1, "replay_lsn": "0/200"}
+    await router.check()
+    assert router.pool() is replica
+
+    replica.error = ConnectionRefusedError()
+    await router.check()
+    assert router.pool() is primary
+
+
+async def test_not_a_standby():
+    primary = object()
+    replica = FakeReplica({"lag": None, "replay_lsn": None})
+    router = ReadRouter(primary, replica)
+    await router.check()
+    assert router.pool() is replica
+    assert router.pool(min_lsn=0) is primary
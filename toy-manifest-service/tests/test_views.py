@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 
 import asyncpg
@@ -159,6 +160,76 @@ async def test_multiple_posts(cli_with_db, caplog):
     assert message["error"]
 
 
+async def test_list_manifests(cli_with_db, caplog):
+    caplog.set_level(logging.INFO)
+    manifest: OCIManifest = {
+        "schemaVersion": 2,
+        "config": OCIContentDescriptor(
+            mediaType="application/vnd.oci.image.config.v1+json",
+            size=6666,
+            digest="sha256:0003b2c507a0944348e0303114d8d93aaaa081732b86451d9bce1f432a537000",
+            annotations={},
+            urls=[],
+        ),
+        "layers": [
+            OCIContentDescriptor(
+                mediaType="application/vnd.oci.image.layer.v1.tar+gzip",
+                size=1111,
+                digest="sha256:1003876dcfb05cb167a5c24953eba58c4ac89b1adf57f28f2f9d09af107ee123",
+                annotations={},
+                urls=[],
+            ),
+            OCIContentDescriptor(
+                mediaType="application/vnd.oci.image.layer.v1.tar+gzip",
+                size=2222,
+                digest="sha256:2003876dcfb05cb167a5c24953eba58c4ac89b1adf57f28f2f9d09af107ee123",
+                annotations={"layer": "two"},
+                urls=[],
+            ),
+        ],
+        "annotations": {},
+        "mediaType": "",
+    }
+
+    with MultipartWriter("mixed") as mpwriter:
+        mpwriter.append_json(manifest)
+        resp = await cli_with_db.post("/manifest", data=mpwriter)
+    assert resp.status == 200, f"Error message {await resp.text()}"
+
+    resp = await cli_with_db.get("/manifests")
+    assert resp.status == 200
+    assert resp.content_type == "application/x-ndjson"
+    manifests = [json.loads(line) async for line in resp.content if line.strip()]
+    assert manifest in manifests
+
+    resp = await cli_with_db.get(
+        "/manifests", params={"since": "2000-01-01", "until": "2000-01-02"}
+    )
+    assert resp.status == 200
+    assert await resp.text() == ""
+
+
+async def test_list_manifests_bad_range(cli):
+    resp = await cli.get("/manifests", params={"since": "yesterday"})
+    assert resp.status == 400
+    message = await resp.json()
+    assert message["message"]
+
+    resp = await cli.get(
+        "/manifests", params={"since": "2020-10-22", "until": "2020-10-15"}
+    )
+    assert resp.status == 400
+
+    # A Z suffix parses, so the range is rejected rather than the timestamps
+    resp = await cli.get(
+        "/manifests",
+        params={"since": "2020-10-22T00:00:00Z", "until": "2020-10-15T00:00:00Z"},
+    )
+    assert resp.status == 400
+    message = await resp.json()
+    assert "must be before" in message["message"]
+
+
 async def test_manifest_validation_good_manifest():
     manifest = OCIManifest(
         schemaVersion=2,